@@ -0,0 +1,93 @@
+import datetime
+from collections import OrderedDict
+
+# numpy (pip install numpy) is optional. Without it the same aggregates are computed with dicts.
+
+
+# Summary name: column of a records.KillmailStore it groups by. day is derived from killmail_time.
+GROUPS = OrderedDict(
+    region='region_id',
+    system='system_id',
+    group='group_id',
+    corporation='corporation_id',
+    alliance='alliance_id',
+    day='day',
+)
+
+# Every day is listed in order, every other group is cut to its top entries by value.
+CHRONOLOGICAL_GROUPS = ('day',)
+
+SECONDS_PER_DAY = 24 * 60 * 60
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+def import_numpy():
+    try:
+        import numpy
+        return numpy
+    except ImportError:
+        return None
+
+def format_day(day):
+    return datetime.date.fromordinal(day + EPOCH_ORDINAL).isoformat()
+
+def aggregate(store, name, top=None):
+    '''Returns [(key, kills, value, points)] of the killmails of store grouped by GROUPS[name].
+
+    Groups are sorted by value, or by key for CHRONOLOGICAL_GROUPS, and cut to top when it is given.
+    Killmails without the key, like those of corporations without an alliance, are left out.
+    '''
+    numpy = import_numpy()
+    if numpy is not None:
+        rows = _aggregate_numpy(numpy, store, GROUPS[name])
+    else:
+        rows = _aggregate_dict(store, GROUPS[name])
+
+    if name in CHRONOLOGICAL_GROUPS:
+        rows.sort(key=lambda row: row[0])
+    else:
+        rows.sort(key=lambda row: (-row[2], -row[1], row[0]))
+        if top is not None:
+            rows = rows[:top]
+    return rows
+
+def _aggregate_numpy(numpy, store, column):
+    values = numpy.frombuffer(store.columns['value'], dtype=numpy.float64)
+    points = numpy.frombuffer(store.columns['points'], dtype=numpy.float64)
+
+    if column == 'day':
+        keys = numpy.frombuffer(store.columns['killmail_time'], dtype=numpy.int64) // SECONDS_PER_DAY
+        known = numpy.ones(len(keys), dtype=bool)
+    else:
+        keys = numpy.frombuffer(store.columns[column], dtype=numpy.int64)
+        known = keys != 0
+
+    unique_keys, inverse = numpy.unique(keys[known], return_inverse=True)
+    kills = numpy.bincount(inverse, minlength=len(unique_keys))
+    total_values = numpy.bincount(inverse, weights=values[known], minlength=len(unique_keys))
+    total_points = numpy.bincount(inverse, weights=points[known], minlength=len(unique_keys))
+
+    return [
+        (int(key), int(count), float(value), float(point))
+        for key, count, value, point in zip(unique_keys, kills, total_values, total_points)
+    ]
+
+def _aggregate_dict(store, column):
+    if column == 'day':
+        keys = (killmail_time // SECONDS_PER_DAY for killmail_time in store.columns['killmail_time'])
+    else:
+        keys = store.columns[column]
+
+    totals = {}
+    for key, value, point in zip(keys, store.columns['value'], store.columns['points']):
+        if not key and column != 'day':
+            continue
+
+        total = totals.get(key)
+        if total is None:
+            totals[key] = [1, value, point]
+        else:
+            total[0] += 1
+            total[1] += value
+            total[2] += point
+
+    return [(key, total[0], total[1], total[2]) for key, total in totals.items()]
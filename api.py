@@ -1,89 +1,140 @@
 import sys
+import os
+import copy
 import threading
-import inspect
-import ctypes
 import builtins
+import multiprocessing
+import concurrent.futures
+from collections import OrderedDict
 
-import zerorpc
-
-import zkillboard2excel
-
-
-# Quote from: https://stackoverflow.com/questions/323972/is-there-any-way-to-kill-a-thread
-def _async_raise(tid, exctype):
-    '''Raises an exception in the threads with id tid'''
-    if not inspect.isclass(exctype):
-        raise TypeError("Only types can be raised (not instances)")
-    res = ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(tid),
-                                                     ctypes.py_object(exctype))
-    if res == 0:
-        raise ValueError("invalid thread id")
-    elif res != 1:
-        # "if it returns a number greater than one, you're in trouble,
-        # and you should call it again with exc=NULL to revert the effect"
-        ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(tid), None)
-        raise SystemError("PyThreadState_SetAsyncExc failed")
-
-class ThreadWithExc(threading.Thread):
-    '''A thread class that supports raising exception in the thread from
-       another thread.
-    '''
-    def _get_my_tid(self):
-        """determines this (self's) thread id
-
-        CAREFUL : this function is executed in the context of the caller
-        thread, to get the identity of the thread represented by this
-        instance.
-        """
-        if not self.isAlive():
-            raise threading.ThreadError("the thread is not active")
+import metrics
 
-        # do we have it cached?
-        if hasattr(self, "_thread_id"):
-            return self._thread_id
 
-        # no, look for it in the _active dict
-        for tid, tobj in threading._active.items():
-            if tobj is self:
-                self._thread_id = tid
-                return tid
+# Number of export jobs running at the same time. Later jobs wait in the queue.
+MAX_RUNNING_JOBS = 2
 
-        # TODO: in python 2.6, there's a simpler way to do : self.ident
+class Job:
+    '''One export with its own settings. state is 'queued', 'running', 'done', 'cancelled' or 'failed'.'''
 
-        raise AssertionError("could not determine the thread's id")
+    def __init__(self, job_id, settings):
+        self.id = job_id
+        self.settings = settings
+        self.state = 'queued'
+        self.error = None
+        self.cancel_event = threading.Event()
 
-    def raiseExc(self, exctype):
-        """Raises the given exception type in the context of this thread.
+    def get_state(self):
+        return {
+            'id': self.id,
+            'state': self.state,
+            'zkb_url': self.settings.get('zkb_url', ''),
+            'error': self.error,
+        }
 
-        If the thread is busy in a system call (time.sleep(),
-        socket.accept(), ...), the exception is simply ignored.
+    def is_exclusive(self):
+        '''Whether the job clears the cache or rewrites the SDE files, which other jobs read while they run.'''
+        return bool(self.settings.get('clear-cache') or self.settings.get('update-sde'))
 
-        If you are sure that your exception should terminate the thread,
-        one way to ensure that it works is:
+    def conflicts(self, other):
+        '''Whether the job can not run alongside other, because one of them is exclusive or both write the same files.'''
+        return self.is_exclusive() or other.is_exclusive() or self.settings.get('filepath') == other.settings.get('filepath')
 
-            t = ThreadWithExc( ... )
-            ...
-            t.raiseExc( SomeException )
-            while t.isAlive():
-                time.sleep( 0.1 )
-                t.raiseExc( SomeException )
+class JobManager:
+    '''Runs export jobs on up to MAX_RUNNING_JOBS threads.
 
-        If the exception is to be caught by the thread, you need a way to
-        check that your thread has caught it.
+    Jobs start in the order they were submitted. A job that conflicts with a running one,
+    see Job.conflicts(), waits for it, and the jobs after an exclusive job wait for it too.
 
-        CAREFUL : this function is executed in the context of the
-        caller thread, to raise an excpetion in the context of the
-        thread represented by this instance.
-        """
-        _async_raise( self._get_my_tid(), exctype )
-# Quote end
+    Jobs are cancelled cooperatively: the export checks its cancel event between
+    requests and pages and commits the cache on the way out.
+    '''
 
+    def __init__(self, append):
+        self._append = append
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_RUNNING_JOBS)
+        self._jobs = OrderedDict()
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def submit(self, settings):
+        '''Queues a job. Returns it and whether it has to wait for other jobs.'''
+        with self._lock:
+            job = Job(self._next_id, settings)
+            self._next_id += 1
+            self._jobs[job.id] = job
+            self._start_jobs()
+            return job, job.state == 'queued'
+
+    def _start_jobs(self):
+        '''Starts the queued jobs that can run now. Called with _lock held.'''
+        running = [job for job in self._jobs.values() if job.state == 'running']
+        for job in self._jobs.values():
+            if len(running) >= MAX_RUNNING_JOBS:
+                break
+            if job.state != 'queued':
+                continue
+            if any(job.conflicts(other) for other in running):
+                if job.is_exclusive():
+                    # Later jobs would keep an exclusive job waiting forever.
+                    break
+                continue
+
+            if not running:
+                metrics.reset()
+            job.state = 'running'
+            running.append(job)
+            self._executor.submit(self._run, job)
+
+    def _run(self, job):
+        # Imported on the first export, so that the server is up before the heavy modules load.
+        import zkillboard2excel
+
+        try:
+            zkillboard2excel.run_job(job.settings, job.cancel_event)
+            job.state = 'done'
+            self._append('Done: job %d' % job.id)
+        except zkillboard2excel.Cancelled:
+            job.state = 'cancelled'
+            self._append('Stop: job %d' % job.id)
+        except Exception as e:
+            job.state = 'failed'
+            job.error = repr(e)
+            self._append('Error: job %d: %s' % (job.id, job.error))
+        finally:
+            with self._lock:
+                self._start_jobs()
+
+    def cancel(self, job_id=None):
+        '''Cancels the job job_id, or every queued and running job when job_id is None.'''
+        with self._lock:
+            if job_id is None:
+                jobs = list(self._jobs.values())
+            elif job_id in self._jobs:
+                jobs = [self._jobs[job_id]]
+            else:
+                return []
+
+            cancelled = []
+            for job in jobs:
+                if job.state in ('queued', 'running'):
+                    if job.state == 'queued':
+                        job.state = 'cancelled'
+                    job.cancel_event.set()
+                    cancelled.append(job.id)
+
+            # A cancelled job may have kept later ones waiting.
+            self._start_jobs()
+            return cancelled
+
+    def get_jobs(self):
+        with self._lock:
+            return [job.get_state() for job in self._jobs.values()]
 
 class Api:
     def __init__(self, _resources_path):
-        self._script = None
         self._resources_path = _resources_path
         self._texts = []
+        self._jobs = JobManager(self._append)
         builtins.print = self._append
 
     def _append(self, text):
@@ -97,31 +148,38 @@ class Api:
             s = s.replace('https://esi.evetech.net/latest', 'esi: ')
             self._texts.append(s)
 
-    def export(self):
-        if self._script:
-            self._append('The script is already running.')
-            return 'running'
-        else:
-            self._script = ThreadWithExc(target=zkillboard2excel.run, args=(self._resources_path,))
-            self._script.start()
-            self._append('Start')
-            return 'start'
-
-    def terminate(self):
-        if self._script:
-            self._script.raiseExc(Exception)
-            self._script = None
-            self._append('Stop')
-        else:
+    def _read_settings(self, settings=None):
+        import zkillboard2excel
+
+        job_settings = copy.deepcopy(zkillboard2excel.DEFAULT_SETTINGS)
+        if settings is None:
+            settings = zkillboard2excel.read_settings_json(os.path.join(self._resources_path, zkillboard2excel.SETTINGS_JSON_PATH))
+        job_settings.update(settings)
+        job_settings['resources_path'] = self._resources_path
+        return job_settings
+
+    def export(self, settings=None):
+        '''Queues an export of settings, or of settings.json as it is now.
+
+        Returns 'start' when the export starts right away and 'running' when it waits for other jobs.
+        '''
+        job, queued = self._jobs.submit(self._read_settings(settings))
+
+        self._append('%s: job %d' % ('Queued' if queued else 'Start', job.id))
+        return 'running' if queued else 'start'
+
+    def terminate(self, job_id=None):
+        '''Cancels the job job_id, or every job when job_id is None.'''
+        cancelled = self._jobs.cancel(job_id)
+        if not cancelled:
             self._append('The script is not running.')
 
         return 'stop'
 
-    def log(self):
-        if self._script and not self._script.is_alive():
-            self._script = None
-            self._append('Done')
+    def jobs(self):
+        return self._jobs.get_jobs()
 
+    def log(self):
         if self._texts:
             text = '&#13;'.join(self._texts)
             self._texts[:] = []
@@ -129,16 +187,24 @@ class Api:
         else:
             return ''
 
+    def stats(self):
+        '''Request, cache, stage, writer and rate limit metrics of the running jobs or the last ones.'''
+        return metrics.get_stats()
+
     def echo(self, text):
         return text
 
 def main():
+    # The SDE generators start worker processes, which a frozen executable has to recognize.
+    multiprocessing.freeze_support()
+
     resources_path = '.'
     if len(sys.argv) >= 2:
         resources_path = sys.argv[1]
 
     api = Api(resources_path)
 
+    import zerorpc
     server = zerorpc.Server(api)
     server.bind('tcp://127.0.0.1:4242')
     server.run()
@@ -0,0 +1,467 @@
+import sys
+import os
+import time
+import json
+import gzip
+import random
+import shutil
+import tempfile
+import threading
+import subprocess
+import http.server
+import urllib.parse
+
+
+OPTIONS = [
+    ('--sizes', 'Comma separated numbers of rows to export. default: 1000,10000,100000'),
+    ('--formats', "Comma separated formats to export. Can use 'excel', 'csv' and 'npz'. default: excel,csv"),
+    ('--latency', 'Seconds the stand-in server waits before each response. default: 0'),
+    ('--error-rate', 'Share of responses the stand-in server fails with 503. default: 0'),
+    ('--big-rate', 'Share of killmails with thousands of attackers. default: 0.002'),
+    ('--workers', 'Number of killmails downloaded at the same time. default: 8'),
+    ('--rate-limit', 'Keep the real per-host rate limits. default: False'),
+    ('--json', 'Path to write the results to as JSON. default: none'),
+]
+
+DEFAULT_SETTINGS = {
+    'sizes': [1000, 10000, 100000],
+    'formats': ['excel', 'csv'],
+    'latency': 0.0,
+    'error-rate': 0.0,
+    'big-rate': 0.002,
+    'workers': 8,
+    'rate-limit': False,
+    'json': '',
+}
+
+ZKB_URL = 'https://zkillboard.com/corporation/98000001/'
+PAGE_SIZE = 200
+BIG_ATTACKERS = 3000
+FIRST_KILLMAIL_ID = 80000000
+FIRST_KILLMAIL_TIME = 1546300800  # 2019-01-01T00:00:00Z
+
+CHARACTER_IDS = range(90000001, 90005001)
+CORPORATION_IDS = range(98000001, 98000501)
+ALLIANCE_IDS = range(99000001, 99000051)
+
+SYNTHETIC_TYPES = {
+    # type_id: (name, group_id)
+    587: ('Rifter', 25),
+    603: ('Merlin', 25),
+    621: ('Caracal', 26),
+    24690: ('Hurricane', 419),
+    641: ('Megathron', 27),
+}
+SYNTHETIC_GROUPS = {
+    # group_id: name
+    25: 'Frigate',
+    26: 'Cruiser',
+    27: 'Battleship',
+    419: 'Combat Battlecruiser',
+}
+
+def get_killmail_ids(size):
+    return [FIRST_KILLMAIL_ID + size - i for i in range(size)]
+
+class Universe:
+    '''The IDs the generator may put into a killmail, taken from the SDE index of the export.'''
+
+    def __init__(self, sde):
+        self.type_ids = list(sde.types.ids)
+        self.system_ids = list(sde.systems.ids)
+
+def generate_killmail(killmail_id, universe, big_rate):
+    '''A deterministic, ESI shaped killmail. Some have BIG_ATTACKERS attackers.'''
+    rand = random.Random(killmail_id)
+
+    attackers_count = rand.randint(1, 30)
+    if rand.random() < big_rate:
+        attackers_count = BIG_ATTACKERS
+
+    attackers = []
+    for i in range(attackers_count):
+        attackers.append({
+            'character_id': rand.choice(CHARACTER_IDS),
+            'corporation_id': rand.choice(CORPORATION_IDS),
+            'damage_done': rand.randint(0, 5000),
+            'final_blow': i == 0,
+            'security_status': round(rand.uniform(-10, 5), 1),
+            'ship_type_id': rand.choice(universe.type_ids),
+            'weapon_type_id': rand.choice(universe.type_ids),
+        })
+
+    victim = {
+        'character_id': rand.choice(CHARACTER_IDS),
+        'corporation_id': rand.choice(CORPORATION_IDS),
+        'damage_taken': rand.randint(100, 500000),
+        'ship_type_id': rand.choice(universe.type_ids),
+        'position': {'x': rand.random(), 'y': rand.random(), 'z': rand.random()},
+        'items': [],
+    }
+    if rand.random() < 0.7:
+        victim['alliance_id'] = rand.choice(ALLIANCE_IDS)
+
+    return {
+        'killmail_id': killmail_id,
+        'killmail_time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(FIRST_KILLMAIL_TIME + (killmail_id - FIRST_KILLMAIL_ID) * 97)),
+        'solar_system_id': rand.choice(universe.system_ids),
+        'victim': victim,
+        'attackers': attackers,
+    }
+
+def generate_zkb(killmail_id):
+    rand = random.Random(-killmail_id)
+    return {
+        'killmail_id': killmail_id,
+        'zkb': {
+            'locationID': 40000000 + killmail_id % 1000,
+            'hash': '%040x' % rand.getrandbits(160),
+            'fittedValue': round(rand.uniform(1e5, 1e9), 2),
+            'totalValue': round(rand.uniform(1e5, 2e9), 2),
+            'points': rand.randint(1, 100),
+            'npc': False,
+            'solo': rand.random() < 0.1,
+            'awox': False,
+        },
+    }
+
+def get_name(name_id):
+    if name_id in CHARACTER_IDS:
+        return ('character', 'Character %d' % name_id)
+    if name_id in CORPORATION_IDS:
+        return ('corporation', 'Corporation %d' % name_id)
+    if name_id in ALLIANCE_IDS:
+        return ('alliance', 'Alliance %d' % name_id)
+    return (None, None)
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    '''Answers like zKillboard and ESI for the paths the exporter uses.'''
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, which Nagle's algorithm would delay by an ACK.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, status, value=None, headers=None):
+        body = b''
+        if value is not None:
+            body = json.dumps(value).encode()
+            if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                body = gzip.compress(body, 1)
+                headers = dict(headers or {}, **{'Content-Encoding': 'gzip'})
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, header in (headers or {}).items():
+            self.send_header(key, header)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _prepare(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        if server.error_rate and random.random() < server.error_rate:
+            self._respond(503, {'error': 'stand-in error'}, {'Retry-After': '0'})
+            return False
+        return True
+
+    def do_GET(self):
+        if not self._prepare():
+            return
+
+        parts = [part for part in urllib.parse.urlsplit(self.path).path.split('/') if part]
+
+        if parts[:1] == ['api'] and 'page' in parts:
+            page = int(parts[parts.index('page') + 1])
+            ids = self.server.killmail_ids[(page - 1) * PAGE_SIZE:page * PAGE_SIZE]
+            self._respond(200, [generate_zkb(killmail_id) for killmail_id in ids])
+        elif parts[:2] == ['latest', 'killmails']:
+            self._respond(200, generate_killmail(int(parts[2]), self.server.universe, self.server.big_rate))
+        elif parts[:1] == ['latest'] and parts[1] in ('characters', 'corporations', 'alliances'):
+            self._respond(200, {'name': get_name(int(parts[2]))[1]})
+        else:
+            self._respond(404, {'error': 'not found'})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not self._prepare():
+            return
+
+        if self.path.startswith('/latest/universe/names/'):
+            names = []
+            for name_id in json.loads(body.decode()):
+                category, name = get_name(name_id)
+                if category is None:
+                    self._respond(404, {'error': 'Ensure all IDs are valid before resolving.'})
+                    return
+                names.append({'id': name_id, 'category': category, 'name': name})
+            self._respond(200, names)
+        else:
+            self._respond(404, {'error': 'not found'})
+
+def start_server(size, universe, latency, error_rate, big_rate):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.killmail_ids = get_killmail_ids(size)
+    server.universe = universe
+    server.latency = latency
+    server.error_rate = error_rate
+    server.big_rate = big_rate
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def prepare_resources(path):
+    '''Copies the reference data into path. A small synthetic types.json is used when none exists.'''
+    here = os.path.dirname(os.path.abspath(__file__))
+    for filename in ('universes.json', 'locale_menuitems.json', 'types.json'):
+        if os.path.isfile(os.path.join(here, filename)):
+            shutil.copy(os.path.join(here, filename), path)
+
+    if not os.path.isfile(os.path.join(path, 'types.json')):
+        languages = ('name', 'de', 'en', 'fr', 'ja', 'ru', 'zh')
+        types = {'version': 'benchmark', 'categories': {'6': dict.fromkeys(languages, 'Ship')}, 'groups': {}, 'types': {}}
+        for group_id, name in SYNTHETIC_GROUPS.items():
+            types['groups'][str(group_id)] = dict(dict.fromkeys(languages, name), category_id=6)
+        for type_id, (name, group_id) in SYNTHETIC_TYPES.items():
+            types['types'][str(type_id)] = dict(dict.fromkeys(languages, name), group_id=group_id)
+
+        with open(os.path.join(path, 'types.json'), 'w', encoding='utf-8') as file:
+            json.dump(types, file)
+
+def get_peak_rss_mb():
+    '''Peak resident memory of this process in MB, or nan where it can not be measured.'''
+    try:
+        # Only on Unix.
+        import resource
+    except ImportError:
+        return get_peak_working_set_mb()
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+def get_peak_working_set_mb():
+    '''The Windows counterpart of the peak resident memory.'''
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD)] + [
+                (name, ctypes.c_size_t) for name in (
+                    'PeakWorkingSetSize',
+                    'WorkingSetSize',
+                    'QuotaPeakPagedPoolUsage',
+                    'QuotaPagedPoolUsage',
+                    'QuotaPeakNonPagedPoolUsage',
+                    'QuotaNonPagedPoolUsage',
+                    'PagefileUsage',
+                    'PeakPagefileUsage',
+                )
+            ]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return float('nan')
+        return counters.PeakWorkingSetSize / (1024 * 1024)
+    except (AttributeError, OSError):
+        return float('nan')
+
+def run_case(file_format, size, settings):
+    '''Exports size rows twice in this process, first with an empty cache and then with a warm one.'''
+    import httpclient
+    import ratelimit
+    import zkillboard2excel
+
+    resources_path = tempfile.mkdtemp(prefix='zkb2excel-benchmark-')
+    try:
+        prepare_resources(resources_path)
+
+        zkillboard2excel.SETTINGS['resources_path'] = resources_path
+        zkillboard2excel.initialize(load_settings=False)
+        universe = Universe(zkillboard2excel.SDE)
+
+        server = start_server(size, universe, settings['latency'], settings['error-rate'], settings['big-rate'])
+        local_url = 'http://127.0.0.1:%d' % server.server_port
+        for host in ('zkillboard.com', 'esi.evetech.net'):
+            httpclient.HOST_OVERRIDES[host] = local_url
+            if not settings['rate-limit']:
+                ratelimit.HOST_LIMITS[host] = {'rate': 1e9, 'max_rate': 1e9}
+
+        zkillboard2excel.SETTINGS.update({
+            'zkb_url': ZKB_URL,
+            'format': file_format,
+            'filepath': os.path.join(resources_path, 'export'),
+            'page': 1,
+            'limit': (size + PAGE_SIZE - 1) // PAGE_SIZE,
+            'workers': settings['workers'],
+        })
+
+        # The exporter prints a line per request, which would be measured too.
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            results = {}
+            for name in ('cold', 'warm'):
+                requests = server.requests
+                started = time.perf_counter()
+                zkillboard2excel.export()
+                seconds = time.perf_counter() - started
+                results[name] = {
+                    'seconds': seconds,
+                    'rows_per_second': size / seconds,
+                    'requests': server.requests - requests,
+                    'requests_per_second': (server.requests - requests) / seconds,
+                }
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+        export_path = zkillboard2excel.SETTINGS['fullpath'] + zkillboard2excel.FORMAT_EXTENSIONS[file_format]
+        server.shutdown()
+        zkillboard2excel.CACHED.close()
+        zkillboard2excel.KILLMAIL_INDEX.close()
+
+        return {
+            'format': file_format,
+            'rows': size,
+            'cold': results['cold'],
+            'warm': results['warm'],
+            'bytes': os.path.getsize(export_path),
+            'peak_rss_mb': get_peak_rss_mb(),
+        }
+    finally:
+        shutil.rmtree(resources_path, ignore_errors=True)
+
+def run_parse(size, settings):
+    '''Measures parse_killmail alone over generated killmails.'''
+    import zkillboard2excel
+
+    resources_path = tempfile.mkdtemp(prefix='zkb2excel-benchmark-')
+    try:
+        prepare_resources(resources_path)
+        zkillboard2excel.SETTINGS['resources_path'] = resources_path
+        zkillboard2excel.SETTINGS['cache-backend'] = 'memory'
+        zkillboard2excel.initialize(load_settings=False)
+        universe = Universe(zkillboard2excel.SDE)
+
+        killmails = [generate_killmail(killmail_id, universe, settings['big-rate']) for killmail_id in get_killmail_ids(size)]
+
+        started = time.perf_counter()
+        for killmail in killmails:
+            zkillboard2excel.parse_killmail(killmail)
+        seconds = time.perf_counter() - started
+
+        return {'format': 'parse_killmail', 'rows': size, 'seconds': seconds, 'rows_per_second': size / seconds}
+    finally:
+        shutil.rmtree(resources_path, ignore_errors=True)
+
+def run_in_subprocess(arguments):
+    # Every case runs in a fresh process, so that peak RSS belongs to that case alone.
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__)] + arguments)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+def print_results(results):
+    print('{0:<16}{1:>8}{2:>10}{3:>12}{4:>12}{5:>10}{6:>12}{7:>10}'.format(
+        'format', 'rows', 'cold s', 'rows/s', 'requests/s', 'warm s', 'warm rows/s', 'RSS MB'))
+
+    for result in results:
+        if 'cold' in result:
+            print('{0:<16}{1:>8}{2:>10.2f}{3:>12.0f}{4:>12.0f}{5:>10.2f}{6:>12.0f}{7:>10.1f}'.format(
+                result['format'],
+                result['rows'],
+                result['cold']['seconds'],
+                result['cold']['rows_per_second'],
+                result['cold']['requests_per_second'],
+                result['warm']['seconds'],
+                result['warm']['rows_per_second'],
+                result['peak_rss_mb'],
+            ))
+        else:
+            print('{0:<16}{1:>8}{2:>10.2f}{3:>12.0f}'.format(
+                result['format'],
+                result['rows'],
+                result['seconds'],
+                result['rows_per_second'],
+            ))
+
+def parse_arguments(arguments, settings):
+    for argument in arguments:
+        try:
+            key, value = argument.split('=', 1)
+
+            if key == '--sizes':
+                settings['sizes'] = [int(size) for size in value.split(',')]
+            elif key == '--formats':
+                settings['formats'] = [file_format for file_format in value.split(',') if file_format in ('excel', 'csv', 'npz')]
+            elif key in ('--latency', '--error-rate', '--big-rate'):
+                settings[key[2:]] = float(value)
+            elif key == '--workers':
+                settings['workers'] = int(value)
+            elif key == '--rate-limit':
+                settings['rate-limit'] = value.lower() == 'true'
+            elif key == '--json':
+                settings['json'] = value
+            else:
+                print("Option Error: '%s' does not exist" % key)
+        except ValueError:
+            print('Value Error: %s' % argument)
+
+def command_line():
+    if len(sys.argv) >= 2 and sys.argv[1] == 'case':
+        settings = dict(DEFAULT_SETTINGS)
+        parse_arguments(sys.argv[4:], settings)
+        if sys.argv[2] == 'parse':
+            result = run_parse(int(sys.argv[3]), settings)
+        else:
+            result = run_case(sys.argv[2], int(sys.argv[3]), settings)
+        print(json.dumps(result))
+        return
+
+    if len(sys.argv) >= 2 and sys.argv[1] in ('-h', '--help'):
+        print('''
+usage: python benchmark.py [options]
+Exports synthetic killmails from a local zKillboard/ESI stand-in server.
+Options and arguments:''')
+
+        for option in OPTIONS:
+            print('{0:<15}: {1}'.format(option[0], option[1]))
+        return
+
+    settings = dict(DEFAULT_SETTINGS)
+    parse_arguments(sys.argv[1:], settings)
+
+    case_arguments = [
+        '--latency=%s' % settings['latency'],
+        '--error-rate=%s' % settings['error-rate'],
+        '--big-rate=%s' % settings['big-rate'],
+        '--workers=%d' % settings['workers'],
+        '--rate-limit=%s' % settings['rate-limit'],
+    ]
+
+    results = []
+    for size in settings['sizes']:
+        results.append(run_in_subprocess(['case', 'parse', str(size)] + case_arguments))
+        for file_format in settings['formats']:
+            results.append(run_in_subprocess(['case', file_format, str(size)] + case_arguments))
+
+    print_results(results)
+
+    if settings['json']:
+        with open(settings['json'], 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=4)
+
+if __name__ == '__main__':
+    command_line()
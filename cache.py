@@ -0,0 +1,319 @@
+import os
+import time
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class MemoryBackend:
+    '''Keeps every entry in dicts ordered from least to most recently used. Nothing survives the process.'''
+
+    def __init__(self):
+        self._namespaces = {}
+
+    def _namespace(self, namespace):
+        return self._namespaces.setdefault(namespace, OrderedDict())
+
+    def get(self, namespace, key, ttl=None):
+        entries = self._namespace(namespace)
+        if key not in entries:
+            return None
+
+        value, updated = entries[key]
+        if ttl is not None and updated + ttl < time.time():
+            # Kept for offline exports until it is downloaded again.
+            return None
+
+        entries.move_to_end(key)
+        return value
+
+    def set(self, namespace, key, value):
+        entries = self._namespace(namespace)
+        entries[key] = (value, time.time())
+        entries.move_to_end(key)
+
+    def delete(self, namespace, key):
+        self._namespace(namespace).pop(key, None)
+
+    def count(self, namespace):
+        return len(self._namespace(namespace))
+
+    def keys(self, namespace):
+        return list(self._namespace(namespace))
+
+    def items(self, namespace, ttl=None):
+        now = time.time()
+        return [
+            (key, value) for key, (value, updated) in self._namespace(namespace).items()
+            if ttl is None or updated + ttl >= now
+        ]
+
+    def evict(self, namespace, max_entries):
+        entries = self._namespace(namespace)
+        while len(entries) > max_entries:
+            entries.popitem(last=False)
+
+    def commit(self):
+        pass
+
+    def clear(self):
+        self._namespaces.clear()
+
+    def close(self):
+        pass
+
+class SqliteBackend:
+    '''Stores every entry as a row of a SQLite database.
+
+    Writes are upserted one by one and become durable on commit(), so a killed
+    export never leaves a half-written cache behind. Reads are remembered in
+    memory and written to the accessed column on commit() for LRU eviction.
+    '''
+
+    def __init__(self, path, legacy_json_path=None):
+        self._lock = threading.RLock()
+        self._accessed = {}
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS cache ('
+            'namespace TEXT NOT NULL, '
+            'key TEXT NOT NULL, '
+            'value TEXT NOT NULL, '
+            'updated REAL NOT NULL DEFAULT 0, '
+            'accessed REAL NOT NULL DEFAULT 0, '
+            'PRIMARY KEY (namespace, key)'
+            ') WITHOUT ROWID'
+        )
+        columns = [row[1] for row in self._connection.execute('PRAGMA table_info(cache)')]
+        for column in ('updated', 'accessed'):
+            if column not in columns:
+                self._connection.execute('ALTER TABLE cache ADD COLUMN %s REAL NOT NULL DEFAULT 0' % column)
+        self._connection.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (namespace, accessed)')
+        self._connection.commit()
+
+        if legacy_json_path and os.path.isfile(legacy_json_path):
+            self.migrate_json(legacy_json_path)
+
+    def migrate_json(self, path):
+        '''Imports a cached.json written by older versions and renames it out of the way.'''
+        print('Migrate: ' + path)
+        with open(path, 'r', encoding='utf-8') as file:
+            try:
+                cached = json.load(file)
+            except ValueError:
+                # A dump that was interrupted half way can not be recovered.
+                cached = {}
+
+        now = time.time()
+        with self._lock:
+            for namespace, values in cached.items():
+                self._connection.executemany(
+                    'INSERT OR REPLACE INTO cache (namespace, key, value, updated, accessed) VALUES (?, ?, ?, ?, ?)',
+                    ((namespace, key, json.dumps(value), now, now) for key, value in values.items()),
+                )
+            self._connection.commit()
+
+        os.replace(path, path + '.migrated')
+
+    def get(self, namespace, key, ttl=None):
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT value, updated FROM cache WHERE namespace = ? AND key = ?',
+                (namespace, key),
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            if ttl is not None and row[1] + ttl < now:
+                # Kept for offline exports until it is downloaded again.
+                return None
+
+            self._accessed[(namespace, key)] = now
+
+        return json.loads(row[0])
+
+    def set(self, namespace, key, value):
+        now = time.time()
+        with self._lock:
+            self._accessed.pop((namespace, key), None)
+            self._connection.execute(
+                'INSERT OR REPLACE INTO cache (namespace, key, value, updated, accessed) VALUES (?, ?, ?, ?, ?)',
+                (namespace, key, json.dumps(value), now, now),
+            )
+
+    def delete(self, namespace, key):
+        with self._lock:
+            self._accessed.pop((namespace, key), None)
+            self._connection.execute(
+                'DELETE FROM cache WHERE namespace = ? AND key = ?',
+                (namespace, key),
+            )
+
+    def count(self, namespace):
+        with self._lock:
+            return self._connection.execute(
+                'SELECT COUNT(*) FROM cache WHERE namespace = ?',
+                (namespace,),
+            ).fetchone()[0]
+
+    def keys(self, namespace):
+        with self._lock:
+            return [row[0] for row in self._connection.execute(
+                'SELECT key FROM cache WHERE namespace = ?',
+                (namespace,),
+            )]
+
+    def items(self, namespace, ttl=None):
+        '''Every fresh entry of namespace in one query. Unlike get(), it does not count as an access.'''
+        updated = 0 if ttl is None else time.time() - ttl
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT key, value FROM cache WHERE namespace = ? AND updated >= ?',
+                (namespace, updated),
+            ).fetchall()
+
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def evict(self, namespace, max_entries):
+        with self._lock:
+            self._flush_accessed()
+            overflow = self.count(namespace) - max_entries
+            if overflow > 0:
+                self._connection.execute(
+                    'DELETE FROM cache WHERE namespace = ? AND key IN '
+                    '(SELECT key FROM cache WHERE namespace = ? ORDER BY accessed LIMIT ?)',
+                    (namespace, namespace, overflow),
+                )
+
+    def _flush_accessed(self):
+        if self._accessed:
+            self._connection.executemany(
+                'UPDATE cache SET accessed = ? WHERE namespace = ? AND key = ?',
+                ((accessed, namespace, key) for (namespace, key), accessed in self._accessed.items()),
+            )
+            self._accessed.clear()
+
+    def commit(self):
+        with self._lock:
+            self._flush_accessed()
+            self._connection.commit()
+
+    def clear(self):
+        with self._lock:
+            self._accessed.clear()
+            self._connection.execute('DELETE FROM cache')
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._flush_accessed()
+            self._connection.commit()
+            self._connection.close()
+
+BACKENDS = {
+    'sqlite': SqliteBackend,
+    'memory': MemoryBackend,
+}
+
+class Policy:
+    '''How long entries of a namespace stay fresh and how many of them are kept.'''
+
+    def __init__(self, ttl=None, max_entries=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+class Namespace:
+    '''A dict like view of one namespace of a backend. Values must not be None.
+
+    Entries older than the TTL of the policy read as missing, so they are downloaded again and
+    overwritten. get_stale() still reads them, for exports that can not download anything.
+    '''
+
+    def __init__(self, backend, name, policy):
+        self._backend = backend
+        self._name = name
+        self.policy = policy
+
+    def __contains__(self, key):
+        return self._backend.get(self._name, key, self.policy.ttl) is not None
+
+    def __getitem__(self, key):
+        value = self._backend.get(self._name, key, self.policy.ttl)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._backend.set(self._name, key, value)
+
+    def __delitem__(self, key):
+        self._backend.delete(self._name, key)
+
+    def __len__(self):
+        return self._backend.count(self._name)
+
+    def get(self, key, default=None):
+        value = self._backend.get(self._name, key, self.policy.ttl)
+        if value is None:
+            return default
+        return value
+
+    def get_stale(self, key, default=None):
+        '''Like get(), but ignores the TTL.'''
+        value = self._backend.get(self._name, key)
+        if value is None:
+            return default
+        return value
+
+    def keys(self):
+        return self._backend.keys(self._name)
+
+    def items(self):
+        return self._backend.items(self._name, self.policy.ttl)
+
+    def evict(self):
+        if self.policy.max_entries is not None:
+            self._backend.evict(self._name, self.policy.max_entries)
+
+class Cache:
+    def __init__(self, namespaces, policies=None):
+        self._namespace_names = namespaces
+        self._policies = {name: Policy() for name in namespaces}
+        if policies:
+            self._policies.update(policies)
+        self._backend = None
+        self._namespaces = {}
+
+    def is_open(self):
+        return self._backend is not None
+
+    def open(self, backend):
+        self.close()
+        self._backend = backend
+        self._namespaces = {name: Namespace(backend, name, self._policies[name]) for name in self._namespace_names}
+
+    def close(self):
+        if self._backend is not None:
+            self._backend.close()
+        self._backend = None
+        self._namespaces = {}
+
+    def policy(self, namespace):
+        return self._policies[namespace]
+
+    def commit(self):
+        '''Evicts the least recently used entries over each limit and makes every write durable.'''
+        for namespace in self._namespaces.values():
+            namespace.evict()
+        self._backend.commit()
+
+    def clear(self):
+        self._backend.clear()
+
+    def __getitem__(self, namespace):
+        return self._namespaces[namespace]
@@ -0,0 +1,283 @@
+import os
+import gzip
+import zlib
+import json
+import queue
+import time
+import threading
+import http.client
+import urllib.error
+import urllib.parse
+
+import metrics
+import ratelimit
+
+USER_AGENT = 'zkillboard2excel (https://github.com/EVEKatsu/zkillboard2excel)'
+TIMEOUT = 60
+POOL_SIZE = 16
+MAX_REDIRECTS = 5
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Sends requests for a host to another 'scheme://host:port' instead, e.g. a local stand-in server.
+# The rate limiter still sees the original host.
+HOST_OVERRIDES = {}
+
+STATS_KEYS = (
+    'requests',
+    'connections',
+    'bytes_received',
+    'bytes_decoded',
+)
+
+STATS = dict.fromkeys(STATS_KEYS, 0)
+
+_POOLS = {}
+_LOCK = threading.Lock()
+
+def _count(key, value=1):
+    with _LOCK:
+        STATS[key] += value
+
+def _get_pool(scheme, netloc):
+    with _LOCK:
+        if (scheme, netloc) not in _POOLS:
+            _POOLS[(scheme, netloc)] = queue.LifoQueue(maxsize=POOL_SIZE)
+        return _POOLS[(scheme, netloc)]
+
+def _acquire_connection(scheme, netloc):
+    try:
+        return _get_pool(scheme, netloc).get_nowait(), True
+    except queue.Empty:
+        pass
+
+    _count('connections')
+    if scheme == 'https':
+        return http.client.HTTPSConnection(netloc, timeout=TIMEOUT), False
+    return http.client.HTTPConnection(netloc, timeout=TIMEOUT), False
+
+def _release_connection(scheme, netloc, connection):
+    try:
+        _get_pool(scheme, netloc).put_nowait(connection)
+    except queue.Full:
+        connection.close()
+
+def _decode(body, encoding):
+    encoding = (encoding or '').lower()
+    if encoding == 'gzip':
+        return gzip.decompress(body)
+    if encoding == 'deflate':
+        return zlib.decompress(body)
+    return body
+
+def _resolve(url):
+    '''Returns (host, parsed, path) of url, where parsed points at the override of the host if there is one.'''
+    parsed = urllib.parse.urlsplit(url)
+    host = parsed.netloc
+    if host in HOST_OVERRIDES:
+        parsed = urllib.parse.urlsplit(HOST_OVERRIDES[host] + urllib.parse.urlunsplit(('', '') + parsed[2:]))
+
+    path = parsed.path or '/'
+    if parsed.query:
+        path += '?' + parsed.query
+    return host, parsed, path
+
+def _send(parsed, method, path, body, headers):
+    while True:
+        connection, reused = _acquire_connection(parsed.scheme, parsed.netloc)
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+        except (http.client.RemoteDisconnected, http.client.BadStatusLine, ConnectionError):
+            connection.close()
+            if reused:
+                # The server dropped an idle keep-alive connection, retry on another one.
+                continue
+            raise
+        except Exception:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            _release_connection(parsed.scheme, parsed.netloc, connection)
+
+        return response, data
+
+def request(url, method='GET', body=None, headers=None):
+    '''Sends a request over a pooled keep-alive connection and returns (status, headers, body).
+
+    Every request waits for the rate limiter of its host first.
+
+    Responses with a 4xx or 5xx status raise urllib.error.HTTPError like urllib.request.urlopen.
+    '''
+    for _ in range(MAX_REDIRECTS + 1):
+        host, parsed, path = _resolve(url)
+
+        request_headers = {
+            'User-Agent': USER_AGENT,
+            'Accept-Encoding': 'gzip, deflate',
+        }
+        if headers:
+            request_headers.update(headers)
+
+        started = time.perf_counter()
+        ratelimit.acquire(host)
+        sent = time.perf_counter()
+        response, data = _send(parsed, method, path, body, request_headers)
+        ratelimit.update(host, response.status, response.headers)
+        metrics.record_request(host, response.status, time.perf_counter() - sent, sent - started)
+
+        _count('requests')
+        _count('bytes_received', len(data))
+        data = _decode(data, response.getheader('Content-Encoding'))
+        _count('bytes_decoded', len(data))
+
+        if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+            url = urllib.parse.urljoin(url, response.getheader('Location'))
+            if response.status == 303:
+                method, body = 'GET', None
+            continue
+
+        if response.status >= 400:
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+
+        return response.status, response.headers, data
+
+    raise urllib.error.HTTPError(url, response.status, 'Too many redirects', response.headers, None)
+
+def _parse_content_range(value):
+    '''Returns (start, total) of a 'bytes start-end/total' Content-Range. Unknown parts are None.'''
+    try:
+        unit, content_range = value.split(' ', 1)
+        byte_range, total = content_range.split('/', 1)
+        start = None if byte_range == '*' else int(byte_range.split('-', 1)[0])
+        return start, None if total == '*' else int(total)
+    except (AttributeError, ValueError):
+        return None, None
+
+def download(url, path, part_path=None):
+    '''Streams url to path DOWNLOAD_CHUNK_SIZE bytes at a time through part_path, path + '.part' by default.
+
+    A download that was interrupted resumes from the end of part_path with a Range request.
+    The connection is not pooled, and the body is never held in memory.
+    '''
+    part_path = part_path or path + '.part'
+
+    for _ in range(MAX_REDIRECTS + 1):
+        offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+
+        host, parsed, path_query = _resolve(url)
+
+        request_headers = {
+            'User-Agent': USER_AGENT,
+            # A compressed body could not be resumed by byte offset.
+            'Accept-Encoding': 'identity',
+        }
+        if offset:
+            request_headers['Range'] = 'bytes=%d-' % offset
+
+        if parsed.scheme == 'https':
+            connection = http.client.HTTPSConnection(parsed.netloc, timeout=TIMEOUT)
+        else:
+            connection = http.client.HTTPConnection(parsed.netloc, timeout=TIMEOUT)
+        _count('connections')
+
+        try:
+            started = time.perf_counter()
+            ratelimit.acquire(host)
+            sent = time.perf_counter()
+            connection.request('GET', path_query, headers=request_headers)
+            response = connection.getresponse()
+            ratelimit.update(host, response.status, response.headers)
+            metrics.record_request(host, response.status, time.perf_counter() - sent, sent - started)
+            _count('requests')
+
+            if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+                url = urllib.parse.urljoin(url, response.getheader('Location'))
+                continue
+
+            if response.status == 416:
+                start, total = _parse_content_range(response.getheader('Content-Range'))
+                if total is not None and total == offset:
+                    # The previous try received everything but stopped before renaming.
+                    os.replace(part_path, path)
+                    return path
+
+                os.remove(part_path)
+                continue
+
+            if response.status >= 400:
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+
+            mode = 'wb'
+            if response.status == 206:
+                start, total = _parse_content_range(response.getheader('Content-Range'))
+                if start != offset:
+                    os.remove(part_path)
+                    continue
+                mode = 'ab'
+
+            with open(part_path, mode) as file:
+                while True:
+                    chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    file.write(chunk)
+                    _count('bytes_received', len(chunk))
+                    _count('bytes_decoded', len(chunk))
+
+            # http.client ends a body cut short by the server like a complete one.
+            if response.length:
+                raise http.client.IncompleteRead(b'', response.length)
+        finally:
+            connection.close()
+
+        os.replace(part_path, path)
+        return path
+
+    raise urllib.error.HTTPError(url, response.status, 'Too many redirects', response.headers, None)
+
+def get_json(url, headers=None):
+    status, response_headers, data = request(url, headers=headers)
+    return json.loads(data.decode())
+
+def post_json(url, value, headers=None):
+    request_headers = {'Content-Type': 'application/json'}
+    if headers:
+        request_headers.update(headers)
+
+    status, response_headers, data = request(url, 'POST', json.dumps(value).encode(), request_headers)
+    return json.loads(data.decode())
+
+def get_stats():
+    with _LOCK:
+        stats = dict(STATS)
+
+    stats['handshakes_saved'] = stats['requests'] - stats['connections']
+    stats['bytes_saved'] = stats['bytes_decoded'] - stats['bytes_received']
+    return stats
+
+def report():
+    stats = get_stats()
+    print('HTTP: %d requests over %d connections (%d handshakes saved), %d bytes received for %d bytes (%d bytes saved)' % (
+        stats['requests'],
+        stats['connections'],
+        stats['handshakes_saved'],
+        stats['bytes_received'],
+        stats['bytes_decoded'],
+        stats['bytes_saved'],
+    ))
+
+def close():
+    with _LOCK:
+        pools = list(_POOLS.values())
+        _POOLS.clear()
+
+    for pool in pools:
+        while True:
+            try:
+                pool.get_nowait().close()
+            except queue.Empty:
+                break
@@ -23,4 +23,4 @@ rd /s /q __pycache__
 rd /s /q api.spec
 rd /s /q build
 
-.\node_modules\.bin\electron-packager . --overwrite --icon="icon.ico" --ignore=".vscode" --ignore=".python-version" --ignore="sde" --ignore="sde.zip" --ignore="settings.json" --ignore="cached.json"
+.\node_modules\.bin\electron-packager . --overwrite --icon="icon.ico" --ignore=".vscode" --ignore=".python-version" --ignore="sde" --ignore="sde.zip" --ignore="settings.json" --ignore="cached.json" --ignore="cached.sqlite3" --ignore="cached.index.sqlite3" --ignore="sde.idx"
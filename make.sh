@@ -11,4 +11,4 @@ rm -rf __pycache__
 rm -rf api.spec
 rm -rf build/
 
-./node_modules/.bin/electron-packager . --overwrite --icon="icon.icns" --ignore=".vscode" --ignore=".python-version" --ignore="sde" --ignore="sde.zip" --ignore="settings.json" --ignore="cached.json"
+./node_modules/.bin/electron-packager . --overwrite --icon="icon.icns" --ignore=".vscode" --ignore=".python-version" --ignore="sde" --ignore="sde.zip" --ignore="settings.json" --ignore="cached.json" --ignore="cached.sqlite3" --ignore="cached.index.sqlite3" --ignore="sde.idx"
@@ -0,0 +1,167 @@
+import time
+import json
+import threading
+import contextlib
+
+import ratelimit
+
+
+# Upper bounds in seconds of the histogram buckets. Slower observations go to the last bucket.
+BUCKETS = (0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+
+class Histogram:
+    '''Counts observations in BUCKETS and keeps their total and maximum. Guarded by the module lock.'''
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                break
+        else:
+            i = len(BUCKETS)
+
+        self.counts[i] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def get_state(self):
+        buckets = {}
+        for bound, count in zip(BUCKETS, self.counts):
+            buckets['<=%g' % bound] = count
+        buckets['>%g' % BUCKETS[-1]] = self.counts[-1]
+
+        return {
+            'count': self.count,
+            'total_seconds': self.total,
+            'mean_seconds': self.total / self.count if self.count else 0.0,
+            'max_seconds': self.max,
+            'buckets': buckets,
+        }
+
+_LOCK = threading.Lock()
+_HOSTS = {}
+_STAGES = {}
+_CACHE = {}
+_COUNTERS = {}
+_STARTED = time.perf_counter()
+
+def reset():
+    '''Forgets everything recorded so far. Called when an export starts.'''
+    global _STARTED
+    with _LOCK:
+        _HOSTS.clear()
+        _STAGES.clear()
+        _CACHE.clear()
+        _COUNTERS.clear()
+        _STARTED = time.perf_counter()
+
+def record_request(host, status, seconds, wait_seconds=0.0):
+    '''Records one HTTP response of host. wait_seconds is the time spent waiting for the rate limiter.'''
+    with _LOCK:
+        if host not in _HOSTS:
+            _HOSTS[host] = {'requests': 0, 'errors': 0, 'wait_seconds': 0.0, 'latency': Histogram()}
+
+        stats = _HOSTS[host]
+        stats['requests'] += 1
+        if status >= 400:
+            stats['errors'] += 1
+        stats['wait_seconds'] += wait_seconds
+        stats['latency'].observe(seconds)
+
+def record_cache(namespace, hit):
+    with _LOCK:
+        stats = _CACHE.setdefault(namespace, {'hits': 0, 'misses': 0})
+        stats['hits' if hit else 'misses'] += 1
+
+def add(name, value=1):
+    with _LOCK:
+        _COUNTERS[name] = _COUNTERS.get(name, 0) + value
+
+def observe(name, seconds):
+    '''Records seconds in the histogram of the stage name.'''
+    with _LOCK:
+        if name not in _STAGES:
+            _STAGES[name] = Histogram()
+        _STAGES[name].observe(seconds)
+
+@contextlib.contextmanager
+def stage(name):
+    '''Records how long the block takes in the histogram of the stage name.
+
+    It takes a few microseconds, so per row work is timed with a Timer instead.
+    '''
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started)
+
+class Timer:
+    '''Adds up the time of many short blocks, e.g. one per row, and records it as one observation of a stage.
+
+    Entering and leaving it takes no lock, so it is cheap enough for every row.
+    Not thread safe, so every thread uses its own.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self._started = None
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds += time.perf_counter() - self._started
+
+    def record(self):
+        '''Records the time added up so far, if any, and starts again from 0.'''
+        if self.seconds:
+            observe(self.name, self.seconds)
+        self.seconds = 0.0
+
+def get_stats():
+    with _LOCK:
+        elapsed = time.perf_counter() - _STARTED
+
+        hosts = {}
+        for host, stats in _HOSTS.items():
+            hosts[host] = {
+                'requests': stats['requests'],
+                'errors': stats['errors'],
+                'requests_per_second': stats['requests'] / elapsed if elapsed else 0.0,
+                'wait_seconds': stats['wait_seconds'],
+                'latency': stats['latency'].get_state(),
+            }
+
+        caches = {}
+        for namespace, stats in _CACHE.items():
+            lookups = stats['hits'] + stats['misses']
+            caches[namespace] = dict(stats, hit_ratio=stats['hits'] / lookups if lookups else 0.0)
+
+        counters = dict(_COUNTERS)
+        stages = {name: histogram.get_state() for name, histogram in _STAGES.items()}
+
+    rows = counters.get('rows', 0)
+    return {
+        'elapsed_seconds': elapsed,
+        'rows': rows,
+        'rows_per_second': rows / elapsed if elapsed else 0.0,
+        'bytes_written': counters.get('bytes_written', 0),
+        'hosts': hosts,
+        'cache': caches,
+        'stages': stages,
+        # The token bucket of each host as it is now, e.g. how far it slowed down after errors.
+        'rate_limits': ratelimit.get_state(),
+    }
+
+def dump(path):
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(get_stats(), file, indent=4)
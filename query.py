@@ -0,0 +1,133 @@
+import sqlite3
+import threading
+
+import records
+
+
+# Columns with an index of their own, each together with killmail_time so that a time range of them is cheap too.
+INDEXED_FIELDS = (
+    'region_id',
+    'system_id',
+    'group_id',
+    'ship_id',
+    'corporation_id',
+    'alliance_id',
+)
+
+# Killmails read from the database at a time by select().
+SELECT_BATCH_ROWS = 1000
+
+def parse_time(value):
+    '''Seconds since 1970-01-01 UTC of a 'YYYY-MM-DD' or 'YYYY-MM-DDTHH:MM:SS' UTC time.'''
+    if len(value) == 10:
+        value += 'T00:00:00'
+    return records.parse_time(value)
+
+class KillmailIndex:
+    '''The fields of every exported killmail as a table of a SQLite database, with an index on each of INDEXED_FIELDS.
+
+    The table is clustered by killmail_time, which never changes, so a time range is read in order
+    without a lookup per killmail.
+
+    It is kept next to the cache, but killmails are never evicted from it, so offline
+    exports query every killmail exported so far without decoding the cache. Writes become
+    durable on commit().
+    '''
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._connection = None
+        # Whether open() created the table, so that it has to be filled from the cache once.
+        self.created = False
+
+    def is_open(self):
+        return self._connection is not None
+
+    def open(self, path):
+        self.close()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+
+        self.created = self._connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'killmails'"
+        ).fetchone() is None
+
+        columns = []
+        for field in records.FIELDS:
+            columns.append('%s %s' % (field, 'REAL' if records.COLUMN_TYPES[field][0] == 'd' else 'INTEGER'))
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS killmails (%s, PRIMARY KEY (killmail_time, killmail_id)) WITHOUT ROWID' % ', '.join(columns)
+        )
+
+        for field in INDEXED_FIELDS:
+            self._connection.execute('CREATE INDEX IF NOT EXISTS killmails_%s ON killmails (%s, killmail_time)' % (field, field))
+        self._connection.commit()
+
+    def add(self, killmails):
+        '''Adds killmails, records.Killmail objects, or updates them, e.g. with the latest value.'''
+        sql = 'INSERT OR REPLACE INTO killmails (%s) VALUES (%s)' % (
+            ', '.join(records.FIELDS),
+            ', '.join('?' * len(records.FIELDS)),
+        )
+        with self._lock:
+            self._connection.executemany(sql, (killmail.to_value() for killmail in killmails))
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM killmails').fetchone()[0]
+
+    def select(self, since=None, until=None, **ids):
+        '''Yields the killmails, records.Killmail objects, from since up to until, newest first.
+
+        since and until are seconds since 1970-01-01 UTC, until itself is left out.
+        Each keyword of ids is a field of INDEXED_FIELDS with the IDs it may have, e.g. region_id=[10000002].
+        '''
+        conditions = []
+        parameters = []
+        if since is not None:
+            conditions.append('killmail_time >= ?')
+            parameters.append(since)
+        if until is not None:
+            conditions.append('killmail_time < ?')
+            parameters.append(until)
+
+        for field, values in ids.items():
+            if field not in INDEXED_FIELDS:
+                raise ValueError('%s is not indexed' % field)
+            if values:
+                conditions.append('%s IN (%s)' % (field, ', '.join('?' * len(values))))
+                parameters.extend(values)
+
+        sql = 'SELECT %s FROM killmails' % ', '.join(records.FIELDS)
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY killmail_time DESC, killmail_id DESC'
+
+        with self._lock:
+            cursor = self._connection.execute(sql, parameters)
+
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(SELECT_BATCH_ROWS)
+            if not rows:
+                break
+
+            for row in rows:
+                yield records.Killmail(*row)
+
+    def commit(self):
+        with self._lock:
+            self._connection.commit()
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute('DELETE FROM killmails')
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.commit()
+                self._connection.close()
+            self._connection = None
@@ -0,0 +1,148 @@
+import time
+import threading
+import email.utils
+
+
+# Requests per second each host starts at and may speed up to.
+HOST_LIMITS = {
+    'zkillboard.com': {'rate': 5, 'max_rate': 10},
+    'esi.evetech.net': {'rate': 20, 'max_rate': 100},
+}
+DEFAULT_LIMITS = {'rate': 10, 'max_rate': 20}
+
+MIN_RATE = 0.5
+RATE_INCREASE = 0.5
+RATE_DECREASE = 0.5
+BURST_SECONDS = 1
+MAX_BACKOFF = 60
+
+# ESI blocks every request for the rest of the window once the error limit reaches 0.
+ESI_ERROR_LIMIT_FLOOR = 10
+
+# Statuses that say the host is overloaded or limiting us, 420 being ESI's error limit.
+# Other client errors, e.g. 404, are about the request and leave the rate alone.
+BACKOFF_STATUSES = (420, 429)
+
+class TokenBucket:
+    '''Hands out requests at an adaptive rate.
+
+    The rate grows a little after every success and halves after every error.
+    pause() stops the bucket until a server given time has passed.
+    '''
+
+    def __init__(self, rate, max_rate):
+        self.rate = float(rate)
+        self.max_rate = float(max_rate)
+        self.tokens = self.rate * BURST_SECONDS
+        self.paused_until = 0
+        self.errors = 0
+        self.error_limit_remain = None
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.tokens + (now - self._updated) * self.rate, self.rate * BURST_SECONDS)
+        self._updated = now
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def succeed(self):
+        with self._lock:
+            self.errors = 0
+            self.rate = min(self.rate + RATE_INCREASE, self.max_rate)
+
+    def fail(self):
+        with self._lock:
+            self.errors += 1
+            self.rate = max(self.rate * RATE_DECREASE, MIN_RATE)
+            backoff = min(2 ** (self.errors - 1), MAX_BACKOFF)
+        self.pause(backoff)
+
+    def get_state(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return {
+                'rate': self.rate,
+                'max_rate': self.max_rate,
+                'tokens': self.tokens,
+                'paused_for': max(self.paused_until - time.monotonic(), 0),
+                'errors': self.errors,
+                'error_limit_remain': self.error_limit_remain,
+            }
+
+_BUCKETS = {}
+_LOCK = threading.Lock()
+
+def get_bucket(host):
+    with _LOCK:
+        if host not in _BUCKETS:
+            limits = HOST_LIMITS.get(host, DEFAULT_LIMITS)
+            _BUCKETS[host] = TokenBucket(limits['rate'], limits['max_rate'])
+        return _BUCKETS[host]
+
+def acquire(host):
+    get_bucket(host).acquire()
+
+def parse_retry_after(value):
+    if not value:
+        return None
+
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+def update(host, status, headers):
+    '''Adapts the bucket of host to a response and its rate limit headers.
+
+    Only 420, 429 and 5xx responses slow the host down. When the server says how long to wait,
+    with Retry-After or the ESI error limit headers, it waits just that long instead.
+    '''
+    bucket = get_bucket(host)
+    told = False
+
+    remain = headers.get('X-Esi-Error-Limit-Remain')
+    reset = headers.get('X-Esi-Error-Limit-Reset')
+    if remain is not None:
+        bucket.error_limit_remain = int(remain)
+        told = True
+        if int(remain) < ESI_ERROR_LIMIT_FLOOR and reset is not None:
+            bucket.pause(int(reset))
+
+    retry_after = parse_retry_after(headers.get('Retry-After'))
+    if retry_after is not None:
+        bucket.pause(retry_after)
+        told = True
+
+    if status in BACKOFF_STATUSES or status >= 500:
+        if not told:
+            bucket.fail()
+    elif status < 400:
+        bucket.succeed()
+
+def get_state():
+    with _LOCK:
+        buckets = dict(_BUCKETS)
+    return {host: bucket.get_state() for host, bucket in buckets.items()}
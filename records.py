@@ -0,0 +1,144 @@
+import zipfile
+import calendar
+from array import array
+from collections import OrderedDict
+
+
+# The fields of a Killmail in the order they are cached.
+FIELDS = (
+    'killmail_id',
+    'killmail_time',
+    'damage_taken',
+    'involved',
+    'ship_id',
+    'group_id',
+    'system_id',
+    'constellation_id',
+    'region_id',
+    'character_id',
+    'corporation_id',
+    'alliance_id',
+    'value',
+    'points',
+)
+
+# IDs a victim may not have.
+OPTIONAL_FIELDS = ('character_id', 'corporation_id', 'alliance_id')
+
+# Typecode of each column of a KillmailStore and the .npy dtype it is written as.
+# killmail_time is kept as seconds since 1970-01-01 UTC.
+COLUMN_TYPES = OrderedDict()
+for _field in FIELDS:
+    COLUMN_TYPES[_field] = ('q', '<i8')
+COLUMN_TYPES['killmail_time'] = ('q', '<M8[s]')
+COLUMN_TYPES['value'] = ('d', '<f8')
+COLUMN_TYPES['points'] = ('d', '<f8')
+
+NPY_MAGIC = b'\x93NUMPY'
+
+def parse_time(killmail_time):
+    '''Seconds since 1970-01-01 UTC of a 'YYYY-MM-DDTHH:MM:SSZ' time, without the format parsing of strptime().'''
+    return calendar.timegm((
+        int(killmail_time[0:4]),
+        int(killmail_time[5:7]),
+        int(killmail_time[8:10]),
+        int(killmail_time[11:13]),
+        int(killmail_time[14:16]),
+        int(killmail_time[17:19]),
+    ))
+
+class Killmail:
+    '''The fields of a killmail that are exported, without the attackers and items of the ESI killmail.
+
+    Reads like the dict it replaces, so killmail['ship_id'] and killmail.ship_id are the same.
+    killmail_time is seconds since 1970-01-01 UTC. IDs the victim does not have are None.
+    '''
+
+    __slots__ = FIELDS
+
+    def __init__(self, *values):
+        for field, value in zip(FIELDS, values):
+            setattr(self, field, value)
+        for field in FIELDS[len(values):]:
+            setattr(self, field, None)
+
+    def __getitem__(self, field):
+        return getattr(self, field)
+
+    @classmethod
+    def from_value(cls, value):
+        '''Creates a killmail from its cached list, or from the dict cached by older versions.'''
+        if isinstance(value, dict):
+            killmail = cls(*(value.get(field) for field in FIELDS))
+        else:
+            killmail = cls(*value)
+
+        # Older versions cached the time as the string of ESI.
+        if isinstance(killmail.killmail_time, str):
+            killmail.killmail_time = parse_time(killmail.killmail_time)
+        return killmail
+
+    def to_value(self):
+        return [getattr(self, field) for field in FIELDS]
+
+class KillmailStore:
+    '''Killmails as one typed array per field, keyed by their int killmail_id.
+
+    Each field takes 8 bytes instead of a dict entry per killmail.
+    Missing IDs, value and points are stored as 0.
+    '''
+
+    def __init__(self):
+        self.columns = OrderedDict((field, array(typecode)) for field, (typecode, dtype) in COLUMN_TYPES.items())
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.columns['killmail_id'])
+
+    def __contains__(self, killmail_id):
+        return killmail_id in self.positions
+
+    def add(self, killmail):
+        if killmail.killmail_id in self.positions:
+            return
+
+        self.positions[killmail.killmail_id] = len(self)
+        for field, column in self.columns.items():
+            column.append(getattr(killmail, field) or 0)
+
+    def get(self, killmail_id):
+        return self.get_at(self.positions[killmail_id])
+
+    def get_at(self, position):
+        killmail = Killmail(*(column[position] for column in self.columns.values()))
+        for field in OPTIONAL_FIELDS:
+            if not getattr(killmail, field):
+                setattr(killmail, field, None)
+        return killmail
+
+    def save_npz(self, path):
+        '''Writes every column as a .npy member of path, which numpy.load() reads back as arrays.'''
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as zfile:
+            for field, column in self.columns.items():
+                zfile.writestr(field + '.npy', _npy_header(COLUMN_TYPES[field][1], len(column)) + column.tobytes())
+
+    @classmethod
+    def load_npz(cls, path):
+        '''Reads a file written by save_npz().'''
+        store = cls()
+        with zipfile.ZipFile(path) as zfile:
+            for field, column in store.columns.items():
+                data = zfile.read(field + '.npy')
+                header_length = int.from_bytes(data[8:10], 'little')
+                column.frombytes(data[10 + header_length:])
+
+        store.positions = dict(zip(store.columns['killmail_id'], range(len(store))))
+        return store
+
+def _npy_header(dtype, length):
+    '''The header of a version 1.0 .npy file of a one dimensional array.'''
+    header = repr({'descr': dtype, 'fortran_order': False, 'shape': (length,)}).encode('latin1')
+    # The data has to start at a multiple of 64 bytes.
+    padding = -(len(NPY_MAGIC) + 4 + len(header) + 1) % 64
+    header += b' ' * padding + b'\n'
+    return NPY_MAGIC + b'\x01\x00' + len(header).to_bytes(2, 'little') + header
@@ -1,17 +1,26 @@
 # v1.2.0
+import io
 import os
+import re
+import glob
+import hashlib
 import time
 import json
 import copy
+import marshal
 import zipfile
+import threading
+import http.client
+import concurrent.futures
+from array import array
 import urllib.error
-import urllib.request
 import urllib.parse
 from collections import OrderedDict
 
-# pip install -r requirements.txt
-import yaml
-from bs4 import BeautifulSoup
+import httpclient
+
+# yaml and bs4 (pip install -r requirements.txt) are only imported by the SDE
+# generators, so that the exporter does not pay for them on every start.
 
 LANGUAGES = [
     'de',
@@ -26,7 +35,35 @@ RESOURCES_PATH = '.'
 
 TYPES_JSON_PATH = 'types.json'
 
+# The SDE is read straight from the downloaded zip, which is never extracted.
+SDE_ZIP_PATH = 'sde.zip'
+DOWNLOAD_RETRY_SECONDS = 1
+
 UNIVERSES_JSON_PATH = 'universes.json'
+
+# Version and SHA-1 of each SDE JSON file, published next to them so that an update check is one small request.
+MANIFEST_JSON_PATH = 'version.json'
+MANIFEST_FILES = (TYPES_JSON_PATH, UNIVERSES_JSON_PATH)
+
+# Local state of the update checks: the ETag of each URL, and when a manifest URL was found missing.
+# Kept apart from version.json, which is published as it is.
+UPDATE_STATE_JSON_PATH = 'sde.update.json'
+# How long a missing manifest is not asked for again, so that its 404 does not slow down every check.
+MANIFEST_RETRY_SECONDS = 24 * 60 * 60
+
+# Localized names fetched so far by an unfinished universe build, so that it can resume.
+NAMES_CHECKPOINT_PATH = 'universes.names.json'
+NAMES_CHECKPOINT_EVERY = 200
+NAMES_WORKERS = 8
+
+# Top-level entries of typeIDs.yaml parsed at once.
+YAML_CHUNK_ENTRIES = 1000
+
+# Processes reading the universe .staticdata files. None means one per CPU.
+SDE_WORKERS = None
+
+SDE_INDEX_PATH = 'sde.idx'
+SDE_INDEX_FORMAT = 1
 UNIVERSE_IDS = OrderedDict(
     eve=1,
     wormhole=2,
@@ -77,6 +114,21 @@ def full_types_json_path():
 def full_universes_json_path():
     return os.path.join(RESOURCES_PATH, UNIVERSES_JSON_PATH)
 
+def full_manifest_json_path():
+    return os.path.join(RESOURCES_PATH, MANIFEST_JSON_PATH)
+
+def full_update_state_json_path():
+    return os.path.join(RESOURCES_PATH, UPDATE_STATE_JSON_PATH)
+
+def full_names_checkpoint_path():
+    return os.path.join(RESOURCES_PATH, NAMES_CHECKPOINT_PATH)
+
+def full_sde_zip_path():
+    return os.path.join(RESOURCES_PATH, SDE_ZIP_PATH)
+
+def full_sde_index_path():
+    return os.path.join(RESOURCES_PATH, SDE_INDEX_PATH)
+
 def initialize(resources_path='.'):
     global RESOURCES_PATH
     RESOURCES_PATH = resources_path
@@ -96,13 +148,95 @@ def get_json_by_url(url):
     while(True):
         try:
             print('Download: ' + url)
-            with urllib.request.urlopen(url) as html:
-                data = json.loads(html.read().decode())
-            time.sleep(0.1)
-            return data
+            return httpclient.get_json(url)
         except urllib.error.HTTPError:
+            # The rate limiter of the host backs off before the next try.
             print('urllib.error.HTTPError: ' + url)
-            time.sleep(10)
+
+def get_yaml_loader():
+    '''The libyaml loader when PyYAML was built with it, the pure Python one otherwise.'''
+    import yaml
+    return getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+def load_yaml(file):
+    import yaml
+    return yaml.load(file, Loader=get_yaml_loader())
+
+def iter_yaml_entries(file):
+    '''Yields the text of each top-level entry of a YAML mapping without parsing it.'''
+    lines = []
+    for line in file:
+        if lines and line[:1] not in (' ', '\t', '\n', '#'):
+            yield ''.join(lines)
+            lines = []
+        lines.append(line)
+
+    if lines:
+        yield ''.join(lines)
+
+def get_fsd_prefix(zfile):
+    '''Returns the name of the fsd directory in the SDE zip, e.g. 'sde/fsd/'.'''
+    for name in zfile.namelist():
+        if name.endswith('fsd/typeIDs.yaml'):
+            return name[:-len('typeIDs.yaml')]
+    raise KeyError('fsd/typeIDs.yaml')
+
+def open_sde_member(zfile, name):
+    return io.TextIOWrapper(zfile.open(name), encoding='utf-8')
+
+def load_yaml_entries(file, key, include_values):
+    '''Yields (id, items) of the top-level entries of a YAML mapping whose key is in include_values.
+
+    Entries are filtered on their text before they are parsed, and parsed
+    YAML_CHUNK_ENTRIES at a time, so the whole file is never in memory.
+    Entries where key can not be found in the text are parsed and left to the caller.
+    '''
+    pattern = None
+    chunk = []
+
+    for entry in iter_yaml_entries(file):
+        if pattern is None:
+            # Only match key at the indentation of the entry, not in nested mappings.
+            indent = re.match(r'[^\n]*\n( +)', entry)
+            pattern = re.compile(r'^%s%s: *(-?\d+) *$' % (indent.group(1) if indent else ' +', re.escape(key)), re.M)
+
+        match = pattern.search(entry)
+        if match and int(match.group(1)) not in include_values:
+            continue
+
+        chunk.append(entry)
+        if len(chunk) >= YAML_CHUNK_ENTRIES:
+            yield from load_yaml(''.join(chunk)).items()
+            chunk = []
+
+    if chunk:
+        yield from load_yaml(''.join(chunk)).items()
+
+# The SDE zip of a worker process, see open_worker_sde_zip().
+_WORKER_ZIP = None
+
+def open_worker_sde_zip(path):
+    global _WORKER_ZIP
+    _WORKER_ZIP = zipfile.ZipFile(path)
+
+def load_universe_values(task):
+    '''Returns the values of names in a .staticdata member of the SDE zip. Runs in a worker process.
+
+    Top-level scalars are read from the text, the file is only parsed when one of them is missing.
+    '''
+    name, names = task
+    text = _WORKER_ZIP.read(name).decode('utf-8')
+
+    values = []
+    for name in names:
+        match = re.search(r'^%s: *(\S+) *$' % re.escape(name), text, re.M)
+        if match is None:
+            target_yaml = load_yaml(text)
+            return [target_yaml[name] for name in names]
+
+        value = match.group(1)
+        values.append(int(value) if re.match(r'-?\d+$', value) else float(value))
+    return values
 
 def get_supported_names(names):
     lang_dict = OrderedDict()
@@ -114,21 +248,69 @@ def get_supported_names(names):
             lang_dict[lang] = names['en']
     return lang_dict
 
-def get_supported_names_by_esi(target_type, target_id, default_name):
-    names = {'en': default_name}
+def fetch_localized_names(targets):
+    '''Returns {(target_type, target_id): names} in every language of LANGUAGES for targets of (target_type, target_id, default_name).
 
-    for lang in LANGUAGES:
-        if lang == 'en':
-            continue
+    ESI has no bulk lookup of localized names, so each name is its own request.
+    The requests run on NAMES_WORKERS threads one language at a time, and every
+    name is checkpointed to disk, so an interrupted build resumes where it stopped.
+    '''
+    checkpoint = get_json_by_file(full_names_checkpoint_path())
+    lock = threading.Lock()
+    fetched = [0]
 
+    def save_checkpoint():
+        path = full_names_checkpoint_path()
+        with open(path + '.tmp', 'w', encoding='utf-8') as file:
+            json.dump(checkpoint, file)
+        os.replace(path + '.tmp', path)
+
+    def fetch(lang, target_type, target_id):
         esi_url = 'https://esi.evetech.net/latest/universe/%s/%d?language=%s' % (
             target_type,
             target_id,
             lang,
         )
+        name = get_json_by_url(esi_url)['name']
+
+        with lock:
+            checkpoint.setdefault(lang, {})['%s/%d' % (target_type, target_id)] = name
+            fetched[0] += 1
+            if fetched[0] % NAMES_CHECKPOINT_EVERY == 0:
+                save_checkpoint()
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=NAMES_WORKERS)
+    futures = []
+    try:
+        for lang in LANGUAGES:
+            if lang == 'en':
+                continue
 
-        names[lang] = get_json_by_url(esi_url)['name']
-    return get_supported_names(names)
+            done = checkpoint.get(lang, {})
+            lang_futures = [
+                executor.submit(fetch, lang, target_type, target_id)
+                for target_type, target_id, default_name in targets
+                if '%s/%d' % (target_type, target_id) not in done
+            ]
+            futures.extend(lang_futures)
+            for future in lang_futures:
+                future.result()
+    finally:
+        # shutdown(cancel_futures=True) needs Python 3.9, so the waiting downloads are cancelled one by one.
+        for future in futures:
+            future.cancel()
+        executor.shutdown()
+        with lock:
+            if fetched[0]:
+                save_checkpoint()
+
+    names = {}
+    for target_type, target_id, default_name in targets:
+        lang_names = {'en': default_name}
+        for lang, lang_checkpoint in checkpoint.items():
+            lang_names[lang] = lang_checkpoint['%s/%d' % (target_type, target_id)]
+        names[(target_type, target_id)] = get_supported_names(lang_names)
+    return names
 
 def generate_types_json(version):
     print('Create: ' + full_types_json_path())
@@ -167,42 +349,72 @@ def generate_types_json(version):
         91, # Super Kerr-Induced Nanocoatings
     ]
 
-    include_group_ids = []
-    base_path = os.path.join(RESOURCES_PATH, 'sde', 'fsd')
+    include_group_ids = set()
 
     types = OrderedDict()
     types['version'] = version
     types['categories'] = OrderedDict()
 
-    with open(os.path.join(base_path, 'categoryIDs.yaml')) as file:
-        for i, items in yaml.load(file, Loader=yaml.FullLoader).items():
-            if i not in include_category_ids:
-                continue
+    with zipfile.ZipFile(full_sde_zip_path()) as zfile:
+        fsd_prefix = get_fsd_prefix(zfile)
 
-            types['categories'][i] = get_supported_names(items['name'])
+        with open_sde_member(zfile, fsd_prefix + 'categoryIDs.yaml') as file:
+            for i, items in load_yaml(file).items():
+                if i not in include_category_ids:
+                    continue
 
-    types['groups'] = OrderedDict()
-    with open(os.path.join(base_path, 'groupIDs.yaml')) as file:
-        for i, items in yaml.load(file, Loader=yaml.FullLoader).items():
-            if items['categoryID'] not in include_category_ids or not items['name']:
-                continue
+                types['categories'][i] = get_supported_names(items['name'])
 
-            include_group_ids.append(i)
-            types['groups'][i] = get_supported_names(items['name'])
-            types['groups'][i]['category_id'] = items['categoryID']
+        types['groups'] = OrderedDict()
+        with open_sde_member(zfile, fsd_prefix + 'groupIDs.yaml') as file:
+            for i, items in load_yaml(file).items():
+                if items['categoryID'] not in include_category_ids or not items['name']:
+                    continue
 
-    types['types'] = {}
-    with open(os.path.join(base_path, 'typeIDs.yaml')) as file:
-        for i, items in yaml.load(file, Loader=yaml.FullLoader).items():
-            if items['groupID'] not in include_group_ids or not items['name']:
-                continue
+                include_group_ids.add(i)
+                types['groups'][i] = get_supported_names(items['name'])
+                types['groups'][i]['category_id'] = items['categoryID']
 
-            types['types'][i] = get_supported_names(items['name'])
-            types['types'][i]['group_id'] = items['groupID']
+        types['types'] = {}
+        # typeIDs.yaml is by far the largest file, so types outside the groups are skipped before parsing.
+        with open_sde_member(zfile, fsd_prefix + 'typeIDs.yaml') as file:
+            for i, items in load_yaml_entries(file, 'groupID', include_group_ids):
+                if items['groupID'] not in include_group_ids or not items['name']:
+                    continue
+
+                types['types'][i] = get_supported_names(items['name'])
+                types['types'][i]['group_id'] = items['groupID']
 
     with open(full_types_json_path(), 'w', encoding='utf-8') as file:
         json.dump(types, file, indent=4)
 
+def find_universe_members(zfile, level_filenames):
+    '''Returns (nest, parent, member, name) for every region, constellation and system of the SDE zip, depth first.
+
+    member is the .staticdata file in the directory name. parent is the universe
+    name for regions and the directory of the parent member otherwise.
+    '''
+    universe_prefix = get_fsd_prefix(zfile) + 'universe/'
+
+    members = []
+    for member in zfile.namelist():
+        if not member.startswith(universe_prefix):
+            continue
+
+        parts = member[len(universe_prefix):].split('/')
+        nest = len(parts) - 3
+        if 0 <= nest < len(level_filenames) and parts[-1] == level_filenames[nest]:
+            members.append((parts[:-1], nest, member))
+
+    # A directory sorts right before everything inside it.
+    members.sort()
+
+    directories = []
+    for parts, nest, member in members:
+        parent = parts[0] if nest == 0 else universe_prefix + '/'.join(parts[:-1])
+        directories.append((nest, parent, member, parts[-1]))
+    return directories
+
 def generate_universes_json(version):
     print('Create: ' + full_universes_json_path())
 
@@ -231,61 +443,257 @@ def generate_universes_json(version):
             'systems': {},
         }
 
-    def get_universe_values(path, *names):
-        values = {}
-        with open(path) as file:
-            target_yaml = yaml.load(file, Loader=yaml.FullLoader)
-            for name in names:
-                values[name] = target_yaml[name]
-        return values
-
-    def recursive(nest, parent_universe_id, path):
-        for name in os.listdir(path):
-            next_path = os.path.join(path, name)
-
-            if not os.path.isdir(next_path):
-                continue
-
+    with zipfile.ZipFile(full_sde_zip_path()) as zfile:
+        directories = find_universe_members(zfile, [level_item[2] for level_item in level_items])
+
+    tasks = []
+    for nest, parent, member, name in directories:
+        level_name, level_id_name, level_filename, parent_level_id_name, level_included_keys = level_items[nest]
+        tasks.append((member, [level_id_name] + level_included_keys))
+
+    universe_ids = {}
+    new_universes = []
+    # There are thousands of small files, so they are read in parallel and consumed in order.
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=SDE_WORKERS,
+        initializer=open_worker_sde_zip,
+        initargs=(full_sde_zip_path(),),
+    ) as executor:
+        for (nest, parent, member, name), values in zip(directories, executor.map(load_universe_values, tasks, chunksize=64)):
             level_name, level_id_name, level_filename, parent_level_id_name, level_included_keys = level_items[nest]
-            values = get_universe_values(os.path.join(next_path, level_filename), level_id_name, *level_included_keys)
 
-            universe_id = values[level_id_name]
+            universe_id = values[0]
             universe_id_str = str(universe_id)
+            universe_ids[member.rsplit('/', 1)[0]] = universe_id
+
+            if nest == 0:
+                parent_universe_id = UNIVERSE_IDS[parent]
+            else:
+                parent_universe_id = universe_ids[parent]
 
             if universe_id_str in cached_universes[level_name]:
-                print('Cached: ' + next_path)
+                print('Cached: ' + member)
                 universes[level_name][universe_id_str] = cached_universes[level_name][universe_id_str]
             else:
-                print('Add: ' + next_path)
-                universes[level_name][universe_id_str] = get_supported_names_by_esi(
-                    level_name,
-                    universe_id,
-                    name,
-                )
-                universes[level_name][universe_id_str][parent_level_id_name] = parent_universe_id
-
-                for key in level_included_keys:
-                    universes[level_name][universe_id_str][key] = values[key]
-
-            if nest < len(level_items):
-                recursive(nest + 1, universe_id, next_path)
-
-    base_path = os.path.join(RESOURCES_PATH, 'sde', 'fsd', 'universe')
-    for universe_name in os.listdir(base_path):
-        recursive_path = os.path.join(base_path, universe_name)
-        if os.path.isdir(recursive_path):
-            recursive(0, UNIVERSE_IDS[universe_name], recursive_path)
+                print('Add: ' + member)
+                # Filled in once the localized names are fetched, keeping the order of the file.
+                universes[level_name][universe_id_str] = OrderedDict()
+
+                extra = OrderedDict()
+                extra[parent_level_id_name] = parent_universe_id
+                for key, value in zip(level_included_keys, values[1:]):
+                    extra[key] = value
+
+                new_universes.append((level_name, universe_id, name, extra))
+
+    names = fetch_localized_names([(level_name, universe_id, name) for level_name, universe_id, name, extra in new_universes])
+    for level_name, universe_id, name, extra in new_universes:
+        universe = universes[level_name][str(universe_id)]
+        universe.update(names[(level_name, universe_id)])
+        universe.update(extra)
 
     with open(full_universes_json_path(), 'w', encoding='utf-8') as file:
         json.dump(universes, file, indent=4)
 
+    if os.path.isfile(full_names_checkpoint_path()):
+        os.remove(full_names_checkpoint_path())
+
+class SdeTable:
+    '''Rows of one SDE table held in arrays. Looked up by int ID through a dict of row positions.'''
+
+    def __init__(self, table):
+        self.ids = array('q', table['ids'])
+        self.positions = dict(zip(self.ids, range(len(self.ids))))
+        self.columns = {}
+        for name, (typecode, data) in table['columns'].items():
+            self.columns[name] = array(typecode, data)
+        self._names = table['names']
+        self.names = {}
+
+    def __contains__(self, target_id):
+        return target_id in self.positions
+
+    def __len__(self):
+        return len(self.ids)
+
+    def value(self, column, target_id):
+        return self.columns[column][self.positions[target_id]]
+
+    def name(self, target_id, lang):
+        if lang not in self.names:
+            # Names are stored joined per language and only split when the language is used.
+            self.names[lang] = self._names[lang].split('\0')
+        return self.names[lang][self.positions[target_id]]
+
+class SdeIndex:
+    '''The compact, int keyed form of types.json and universes.json written by generate_sde_index().'''
+
+    TABLES = (
+        'categories',
+        'groups',
+        'types',
+        'regions',
+        'constellations',
+        'systems',
+    )
+
+    def __init__(self):
+        self.version = None
+        self.load_seconds = None
+        self._resources_path = None
+        self._lock = threading.Lock()
+
+    def open(self, resources_path):
+        '''Forgets loaded tables. They are loaded again from resources_path on first use.'''
+        for name in self.TABLES:
+            self.__dict__.pop(name, None)
+        self.version = None
+        self._resources_path = resources_path
+
+    def is_open(self):
+        return self._resources_path is not None
+
+    def __getattr__(self, name):
+        if name in SdeIndex.TABLES and self.__dict__.get('_resources_path') is not None:
+            with self._lock:
+                # Another thread may have loaded the tables while this one waited.
+                if name not in self.__dict__:
+                    load_sde_index(self, self._resources_path)
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    def load(self, path):
+        with open(path, 'rb') as file:
+            data = marshal.load(file)
+
+        if data.get('format') != SDE_INDEX_FORMAT:
+            raise ValueError('Unsupported SDE index format: ' + path)
+
+        for name in self.TABLES:
+            setattr(self, name, SdeTable(data[name]))
+        self.version = data['version']
+
+def _build_sde_table(rows, columns):
+    ids = sorted(int(row_id) for row_id in rows)
+
+    table = {
+        'ids': array('q', ids).tobytes(),
+        'columns': {},
+        'names': {},
+    }
+
+    for lang in LANGUAGES:
+        table['names'][lang] = '\0'.join(rows[str(row_id)][lang] for row_id in ids)
+
+    for name, typecode, resolve in columns:
+        values = array(typecode, (resolve(rows[str(row_id)]) for row_id in ids))
+        table['columns'][name] = (typecode, values.tobytes())
+
+    return table
+
+def generate_sde_index():
+    print('Create: ' + full_sde_index_path())
+
+    types = get_json_by_file(full_types_json_path())
+    universes = get_json_by_file(full_universes_json_path())
+
+    groups = types['groups']
+    systems = universes['systems']
+    constellations = universes['constellations']
+
+    def type_group_id(row):
+        return row['group_id']
+
+    def type_category_id(row):
+        return groups[str(row['group_id'])]['category_id'] if str(row['group_id']) in groups else 0
+
+    def system_constellation_id(row):
+        return row['constellation_id']
+
+    def system_region_id(row):
+        return constellations[str(row['constellation_id'])]['region_id']
+
+    data = {
+        'format': SDE_INDEX_FORMAT,
+        'version': universes['version'],
+        'categories': _build_sde_table(types['categories'], []),
+        'groups': _build_sde_table(groups, [
+            ('category_id', 'q', lambda row: row['category_id']),
+        ]),
+        'types': _build_sde_table(types['types'], [
+            ('group_id', 'q', type_group_id),
+            ('category_id', 'q', type_category_id),
+        ]),
+        'regions': _build_sde_table(universes['regions'], [
+            ('universe_id', 'q', lambda row: row['universe_id']),
+        ]),
+        'constellations': _build_sde_table(constellations, [
+            ('region_id', 'q', lambda row: row['region_id']),
+        ]),
+        'systems': _build_sde_table(systems, [
+            ('constellation_id', 'q', system_constellation_id),
+            ('region_id', 'q', system_region_id),
+            ('security', 'd', lambda row: row['security']),
+        ]),
+    }
+
+    path = full_sde_index_path()
+    with open(path + '.tmp', 'wb') as file:
+        marshal.dump(data, file)
+    os.replace(path + '.tmp', path)
+
+def load_sde_index(index, resources_path='.'):
+    '''Loads the SDE index into index, rebuilding it first when it is missing or older than the JSON files.'''
+    global RESOURCES_PATH
+    RESOURCES_PATH = resources_path
+    started = time.perf_counter()
+
+    index_path = full_sde_index_path()
+    json_paths = [full_types_json_path(), full_universes_json_path()]
+
+    rebuild = not os.path.isfile(index_path)
+    if not rebuild and all(os.path.isfile(path) for path in json_paths):
+        rebuild = max(os.path.getmtime(path) for path in json_paths) > os.path.getmtime(index_path)
+
+    if not rebuild:
+        try:
+            index.load(index_path)
+            index.load_seconds = time.perf_counter() - started
+            return
+        except (ValueError, EOFError, TypeError, KeyError):
+            # Written by another version of this script or Python.
+            pass
+
+    generate_sde_index()
+    index.load(index_path)
+    index.load_seconds = time.perf_counter() - started
+
+def download_sde_zip(sde_url, sde_filename):
+    '''Streams the SDE zip to disk. An interrupted download of the same version resumes.'''
+    # The partial file is named after the version, so that parts of another version are never resumed.
+    part_path = os.path.join(RESOURCES_PATH, sde_filename + '.part')
+    for path in glob.glob(os.path.join(RESOURCES_PATH, 'sde-*.zip.part')):
+        if path != part_path:
+            os.remove(path)
+
+    while(True):
+        try:
+            print('Download: ' + sde_url)
+            return httpclient.download(sde_url, full_sde_zip_path(), part_path)
+        except (urllib.error.HTTPError, OSError, http.client.HTTPException) as e:
+            # Everything received so far stays in the partial file.
+            print('%s: %s' % (type(e).__name__, sde_url))
+            time.sleep(DOWNLOAD_RETRY_SECONDS)
+
 def update_resources(old_version):
+    from bs4 import BeautifulSoup
+
     resources_url = 'https://developers.eveonline.com/resource/resources'
 
     while(True):
         try:
-            with urllib.request.urlopen(resources_url) as html:
-                soup = BeautifulSoup(html, 'html.parser')
+            status, headers, html = httpclient.request(resources_url)
+            soup = BeautifulSoup(html, 'html.parser')
             break
         except urllib.error.HTTPError:
             print('urllib.error.HTTPError: ' + resources_url)
@@ -304,27 +712,134 @@ def update_resources(old_version):
                     break
 
                 print("Update SDE to '%s'" % version)
-                full_sde_path = os.path.join(RESOURCES_PATH, 'sde.zip')
-
-                while(True):
-                    try:
-                        print('Download: ' + sde_url)
-                        with urllib.request.urlopen(sde_url) as data:
-                            with open(full_sde_path, mode='wb') as file:
-                                file.write(data.read())
-                        break
-                    except urllib.error.HTTPError:
-                        print('urllib.error.HTTPError: ' + sde_url)
-
-                print('Extract: ' + full_sde_path)
-                with zipfile.ZipFile(full_sde_path) as zfile:
-                    zfile.extractall()
+                download_sde_zip(sde_url, sde_filename)
     return version
 
-def update_from_processed(types_json_url, universes_json_url, resources_path='.'):
+def get_file_digest(path):
+    if not os.path.isfile(path):
+        return None
+
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def write_manifest_json(version):
+    manifest = OrderedDict()
+    manifest['version'] = version
+    manifest['files'] = OrderedDict((filename, get_file_digest(os.path.join(RESOURCES_PATH, filename))) for filename in MANIFEST_FILES)
+
+    with open(full_manifest_json_path(), 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=4)
+
+def get_data_by_url(url, etag=None):
+    '''Returns (status, etag, data) of a GET that is conditional on etag.
+
+    status is 304 with no data when url did not change since etag, and 404 when url does not exist.
+    '''
+    headers = {'If-None-Match': etag} if etag else None
+    while(True):
+        try:
+            print('Download: ' + url)
+            status, response_headers, data = httpclient.request(url, headers=headers)
+            return status, response_headers.get('ETag'), data
+        except urllib.error.HTTPError as e:
+            print('urllib.error.HTTPError: ' + url)
+            if e.code == 404:
+                return 404, None, None
+
+def read_update_state():
+    state = get_json_by_file(full_update_state_json_path())
+    state.setdefault('etags', {})
+    state.setdefault('missing', {})
+    return state
+
+def write_update_state(state):
+    write_file_atomically(full_update_state_json_path(), json.dumps(state, indent=4).encode())
+
+def write_file_atomically(path, data):
+    with open(path + '.tmp', 'wb') as file:
+        file.write(data)
+    os.replace(path + '.tmp', path)
+
+def update_from_manifest(manifest_url, file_urls):
+    '''Updates the SDE JSON files whose SHA-1 differs from the manifest at manifest_url.
+
+    Returns False when there is no manifest. Otherwise the check is a single
+    request, answered with 304 Not Modified while the manifest is unchanged.
+    '''
+    state = read_update_state()
+    missing = state['missing'].get(manifest_url)
+    if missing is not None and missing + MANIFEST_RETRY_SECONDS > time.time():
+        return False
+
+    local_manifest = get_json_by_file(full_manifest_json_path())
+    etag = state['etags'].get(manifest_url) if local_manifest else None
+
+    status, etag, data = get_data_by_url(manifest_url, etag)
+    if status == 404:
+        state['missing'][manifest_url] = time.time()
+        write_update_state(state)
+        return False
+
+    state['missing'].pop(manifest_url, None)
+    if status == 304:
+        print('SDE is the latest version(%s).' % local_manifest['version'])
+        return True
+
+    manifest = json.loads(data.decode())
+    changed = [
+        filename for filename in MANIFEST_FILES
+        if manifest['files'].get(filename) != get_file_digest(os.path.join(RESOURCES_PATH, filename))
+    ]
+
+    if not changed:
+        print('SDE is the latest version(%s).' % manifest['version'])
+        write_manifest_json(manifest['version'])
+        state['etags'][manifest_url] = etag
+        write_update_state(state)
+        return True
+
+    print("Update SDE to '%s'" % manifest['version'])
+    for filename in changed:
+        status, file_etag, data = get_data_by_url(file_urls[filename])
+        if status != 200 or hashlib.sha1(data).hexdigest() != manifest['files'][filename]:
+            # The files may be served from a cache that lags behind the manifest. The next check tries again.
+            print('Mismatch: ' + file_urls[filename])
+            etag = None
+            continue
+
+        write_file_atomically(os.path.join(RESOURCES_PATH, filename), data)
+
+    generate_sde_index()
+    write_manifest_json(manifest['version'])
+    state['etags'][manifest_url] = etag
+    write_update_state(state)
+    return True
+
+def update_from_processed(types_json_url, universes_json_url, resources_path='.', manifest_url=None):
     old_version = initialize(resources_path)
 
-    universes = get_json_by_url(universes_json_url)
+    file_urls = {
+        TYPES_JSON_PATH: types_json_url,
+        UNIVERSES_JSON_PATH: universes_json_url,
+    }
+    if manifest_url and update_from_manifest(manifest_url, file_urls):
+        return
+
+    # Without a manifest, universes.json itself is downloaded only when it changed since the last check.
+    state = read_update_state()
+    etag = state['etags'].get(universes_json_url) if os.path.isfile(full_universes_json_path()) else None
+    status, etag, data = get_data_by_url(universes_json_url, etag)
+    if status == 404:
+        return
+
+    if status == 304:
+        print('SDE is the latest version(%s).' % old_version)
+        return
+
+    universes = json.loads(data.decode())
     version = universes['version']
 
     if version != old_version:
@@ -336,9 +851,14 @@ def update_from_processed(types_json_url, universes_json_url, resources_path='.'
 
         with open(full_universes_json_path(), 'w', encoding='utf-8') as file:
             json.dump(universes, file, indent=4)
+
+        generate_sde_index()
     else:
         print('SDE is the latest version(%s).' % version)
 
+    state['etags'][universes_json_url] = etag
+    write_update_state(state)
+
 def update_from_developers(resources_path='.'):
     old_version = initialize(resources_path)
 
@@ -348,6 +868,8 @@ def update_from_developers(resources_path='.'):
         print('Update SDE to ' + version)
         generate_types_json(version)
         generate_universes_json(version)
+        generate_sde_index()
+        write_manifest_json(version)
     else:
         print('SDE is the latest version(%s).' % version)
 
@@ -1,28 +1,60 @@
+import time
+STARTED = time.perf_counter()
+
 import sys
 import os
-import time
 import datetime
 import json
 import csv
 import copy
+import contextlib
+import itertools
+import threading
+import concurrent.futures
+import collections.abc
 import urllib.error
-import urllib.request
 import urllib.parse
 from collections import OrderedDict
 
-import openpyxl
-
+import aggregate
+import cache
+import httpclient
+import metrics
+import query
+import records
 import sde2json
 
 
 OPTIONS = [
     ('--lang', "The language of a export file. Can use 'de', 'en', 'fr', 'ja', 'ru', 'zh'. default: 'en'"),
     ('--filepath', 'Path after desktop to export file. default: export'),
-    ('--format', "File format to export. Can use 'excel' or 'csv'. default: excel"),
+    ('--format', "File format to export. Can use 'excel', 'csv' or 'npz', numpy arrays of the killmail fields. default: excel"),
     ('--clear-cache', 'Finally, clear the cache. default: False'),
+    ('--cache-max', 'Maximum number of killmails kept in the cache. Offline exports are not limited by it. default: 100000'),
+    ('--cache-backend', "Where to keep the cache. Can use 'sqlite' or 'memory'. default: sqlite"),
     ('--update-sde', 'Check for SDE Updates. default: False'),
     ('--page', 'Start page of zKillboard API. default: 1'),
     ('--limit', 'Number of pages read. default: 1'),
+    ('--columns', "Comma separated columns to export in order. e.g. 'killmail_id,ship,value'. default: all"),
+    ('--startup-profile', 'Print how long each startup phase takes. default: False'),
+    ('--incremental', 'Only export killmails newer than the last export of the URL to the file and append them, newest first, after the older ones: at the end of the file, of a shard with room, or in new shards in front of the old ones. Pages past --limit are read until the last export is reached. default: False'),
+    ('--workers', 'Number of killmails downloaded at the same time. Exports running at the same time share the most any of them asks for. default: 8'),
+    ('--batch', 'Path of a file with one zKillboard URL and its options per line. Used instead of zKillboard-URL.'),
+    ('--batch-jobs', 'Number of batch URLs exported at the same time. default: 4'),
+    ('--batch-output', 'Path after desktop to one Excel file with a sheet per batch URL. default: a file per URL'),
+    ('--metrics', 'Path to write request, cache, stage, writer and rate limit metrics to as JSON. default: none'),
+    ('--summary', 'Also export kills, value and points by region, system, ship group, corporation, alliance and day. default: False'),
+    ('--summary-top', 'Number of groups with the highest value kept in each summary. Days are all kept. default: 100'),
+    ('--offline', 'Export the killmails exported so far that match --since, --until, --region, --group, --corporation and --alliance without any request. They are kept in an index next to the cache until it is cleared. default: False'),
+    ('--since', "Only killmails from this UTC time. e.g. '2019-03-01' or '2019-03-01T12:00:00'. default: none"),
+    ('--until', 'Only killmails before this UTC time. default: none'),
+    ('--region', 'Comma separated region IDs the killmails have to be in. default: any'),
+    ('--group', 'Comma separated ship group IDs the victim has to fly. default: any'),
+    ('--corporation', 'Comma separated corporation IDs the victim has to be in. default: any'),
+    ('--alliance', 'Comma separated alliance IDs the victim has to be in. default: any'),
+    ('--shard-rows', 'Maximum number of killmails in an Excel sheet or file. default: 1048575'),
+    ('--shard-by', "Start a new Excel sheet or file only when one is full ('rows') or also at every month ('month'). default: rows"),
+    ('--shard-output', "Write the shards of an Excel export as 'sheets' of one file, or as 'files' in parallel with an index file. default: sheets"),
 ]
 
 LANGUAGES = [
@@ -34,9 +66,11 @@ LANGUAGES = [
     'zh',
 ]
 
-TYPES_JSON_PATH = 'types.json'
-
-UNIVERSES_JSON_PATH = 'universes.json'
+FORMAT_EXTENSIONS = {
+    'excel': '.xlsx',
+    'csv': '.csv',
+    'npz': '.npz',
+}
 
 SETTINGS_JSON_PATH = 'settings.json'
 DEFAULT_SETTINGS = {
@@ -45,18 +79,71 @@ DEFAULT_SETTINGS = {
     'filepath': 'export',
     'format': 'excel',
     'clear-cache': False,
+    'cache-backend': 'sqlite',
+    'cache-max': 100000,
     'update-sde': False,
     'page': 1,
     'limit': 1,
+    'workers': 8,
+    'columns': [],
+    'startup-profile': False,
+    'incremental': False,
+    'batch': '',
+    'batch-jobs': 4,
+    'batch-output': '',
+    'metrics': '',
+    'summary': False,
+    'summary-top': 100,
+    'offline': False,
+    'since': '',
+    'until': '',
+    'region': [],
+    'group': [],
+    'corporation': [],
+    'alliance': [],
+    'shard-rows': 1048575,
+    'shard-by': 'rows',
+    'shard-output': 'sheets',
+}
+
+NAMES_URL = 'https://esi.evetech.net/latest/universe/names/'
+NAMES_LIMIT = 1000
+NAMES_CATEGORIES = {
+    'character': 'characters',
+    'corporation': 'corporations',
+    'alliance': 'alliances',
 }
 
 CACHED_JSON_PATH = 'cached.json'
+CACHED_DB_PATH = 'cached.sqlite3'
+# A database of its own, so that its writes never wait for the open transaction of the cache.
+CACHED_INDEX_DB_PATH = 'cached.index.sqlite3'
 CACHED_KEYS = (
     'killmails',
     'characters',
     'corporations',
     'alliances',
 )
+CACHED_POLICIES = {
+    # Killmails never change, so they are only evicted when the cache is full.
+    'killmails': cache.Policy(max_entries=DEFAULT_SETTINGS['cache-max']),
+    'characters': cache.Policy(ttl=30 * 24 * 60 * 60),
+    'corporations': cache.Policy(ttl=7 * 24 * 60 * 60),
+    'alliances': cache.Policy(ttl=7 * 24 * 60 * 60),
+}
+
+INCREMENTAL_JSON_PATH = 'incremental.json'
+
+# Killmails built into rows at a time by an offline export, like a page of zKillboard.
+OFFLINE_BATCH_ROWS = 1000
+
+# Setting of an offline filter: the field of the killmails it matches.
+OFFLINE_FILTERS = OrderedDict(
+    region='region_id',
+    group='group_id',
+    corporation='corporation_id',
+    alliance='alliance_id',
+)
 
 LOCALE_MENUITEMS_JSON_PATH = 'locale_menuitems.json'
 MENUITEMS = (
@@ -94,17 +181,139 @@ FOCUS_KEYS = [
     'group',
 ]
 
-SETTINGS = copy.deepcopy(DEFAULT_SETTINGS)
-CACHED = {}
-TYPES = {}
-UNIVERSES = {}
+EXCEL_STYLES = OrderedDict(
+    normal='006400',
+    focus='8B0000',
+)
+EXCEL_TAIL_COLUMNS = 3
+# Number format of the datetime cells, shared through the '_time' variant of each style.
+EXCEL_TIME_FORMAT = 'yyyy-mm-dd hh:mm'
+
+UNIX_EPOCH = datetime.datetime(1970, 1, 1)
+
+SHARD_MODES = ('rows', 'month')
+SHARD_OUTPUTS = ('sheets', 'files')
+EXCEL_INDEX_TITLE = 'index'
+EXCEL_INDEX_COLUMNS = (
+    'shard',
+    'kills',
+    'newest',
+    'oldest',
+)
+# Processes writing the files of a sharded export. None means one per CPU.
+EXCEL_WORKERS = None
+
+SUMMARY_COLUMNS = (
+    'kills',
+    'value',
+    'points',
+)
+
+class Settings(collections.abc.MutableMapping):
+    '''The settings of the export running on the current thread.
+
+    Batch exports and API jobs run on their own threads with their own settings, see use().
+    Every other thread shares one dict.
+    '''
+
+    def __init__(self, settings):
+        self._shared = settings
+        self._local = threading.local()
+
+    def _settings(self):
+        return getattr(self._local, 'settings', self._shared)
+
+    def use(self, settings=None):
+        '''Gives the current thread its own settings, or the shared ones again when settings is None.'''
+        if settings is None:
+            self._local.__dict__.pop('settings', None)
+        else:
+            self._local.settings = settings
+
+    def __getitem__(self, key):
+        return self._settings()[key]
+
+    def __setitem__(self, key, value):
+        self._settings()[key] = value
+
+    def __delitem__(self, key):
+        del self._settings()[key]
+
+    def __iter__(self):
+        return iter(self._settings())
+
+    def __len__(self):
+        return len(self._settings())
+
+class Cancelled(Exception):
+    '''Raised in an export once the cancel event of its thread is set, see use_cancel_event().'''
+
+SETTINGS = Settings(copy.deepcopy(DEFAULT_SETTINGS))
+CACHED = cache.Cache(CACHED_KEYS, CACHED_POLICIES)
+KILLMAIL_INDEX = query.KillmailIndex()
+SDE = sde2json.SdeIndex()
 LOCALE_MENUITEMS = {}
 
-def full_types_json_path():
-    return os.path.join(SETTINGS['resources_path'], TYPES_JSON_PATH)
+# openpyxl takes a while to import, so it is only imported for Excel exports.
+openpyxl = None
+
+# Shared by every export of the process, so that a killmail on several boards is downloaded once.
+# IDs ESI answers with 404, exported as they are instead of being asked for again.
+UNRESOLVABLE_NAMES = set()
+
+FETCH_EXECUTOR = None
+FETCH_WORKERS = None
+FETCH_FUTURES = {}
+FETCH_LOCK = threading.Lock()
+
+INCREMENTAL_LOCK = threading.Lock()
 
-def full_universes_json_path():
-    return os.path.join(SETTINGS['resources_path'], UNIVERSES_JSON_PATH)
+# How often an export waiting for downloads checks whether it was cancelled.
+CANCEL_POLL_SECONDS = 0.5
+_CANCEL = threading.local()
+
+# Threads running an API job, see run_job(). They share the cache and the SDE files.
+ACTIVE_JOBS = set()
+ACTIVE_JOBS_LOCK = threading.Lock()
+
+STARTUP_TIMINGS = OrderedDict()
+STARTUP_TIMINGS['import modules'] = time.perf_counter() - STARTED
+
+@contextlib.contextmanager
+def startup_phase(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STARTUP_TIMINGS[name] = STARTUP_TIMINGS.get(name, 0) + time.perf_counter() - started
+
+def print_startup_profile():
+    timings = OrderedDict(STARTUP_TIMINGS)
+    if SDE.load_seconds is not None:
+        timings['load sde index'] = SDE.load_seconds
+
+    for name, seconds in timings.items():
+        print('Startup: {0:<20}: {1:8.1f} ms'.format(name, seconds * 1000))
+
+def use_cancel_event(event=None):
+    '''Lets the export on the current thread be cancelled by setting event, or never when event is None.'''
+    _CANCEL.event = event
+
+def check_cancelled():
+    event = getattr(_CANCEL, 'event', None)
+    if event is not None and event.is_set():
+        raise Cancelled()
+
+def is_other_job_active():
+    '''Whether an API job other than the one on the current thread is running.'''
+    with ACTIVE_JOBS_LOCK:
+        return bool(ACTIVE_JOBS - {threading.get_ident()})
+
+def import_openpyxl():
+    global openpyxl
+    if openpyxl is None:
+        with startup_phase('import openpyxl'):
+            import openpyxl
 
 def full_setting_json_path():
     if 'resources_path' in SETTINGS:
@@ -117,41 +326,71 @@ def full_setting_json_path():
 def full_cached_json_path():
     return os.path.join(SETTINGS['resources_path'], CACHED_JSON_PATH)
 
+def full_cached_db_path():
+    return os.path.join(SETTINGS['resources_path'], CACHED_DB_PATH)
+
+def full_cached_index_db_path():
+    return os.path.join(SETTINGS['resources_path'], CACHED_INDEX_DB_PATH)
+
+def full_incremental_json_path():
+    return os.path.join(SETTINGS['resources_path'], INCREMENTAL_JSON_PATH)
+
 def full_locale_menuitems_json_path():
     return os.path.join(SETTINGS['resources_path'], LOCALE_MENUITEMS_JSON_PATH)
 
-def initialize():
-    if os.path.isfile(full_setting_json_path()):
-        for setting_key, setting_value in get_json_by_file(full_setting_json_path()).items():
-            if isinstance(setting_value, str) and not setting_value:
-                continue
-
-            SETTINGS[setting_key] = setting_value
+def read_settings_json(path):
+    '''Returns the settings of a settings.json. Empty strings mean the default.'''
+    settings = {}
+    for setting_key, setting_value in get_json_by_file(path).items():
+        if isinstance(setting_value, str) and not setting_value:
+            continue
 
-    if SETTINGS['update-sde']:
-        sde2json.update_from_processed(
-            types_json_url='https://raw.githubusercontent.com/EVEKatsu/zkillboard2excel/master/types.json',
-            universes_json_url='https://raw.githubusercontent.com/EVEKatsu/zkillboard2excel/master/universes.json',
-            resources_path=SETTINGS['resources_path'],
-        )
+        settings[setting_key] = setting_value
+    return settings
+
+def initialize(load_settings=True):
+    with startup_phase('load settings'):
+        if load_settings:
+            SETTINGS.update(read_settings_json(full_setting_json_path()))
+
+    # The SDE files are rewritten and the cache cleared under the feet of other jobs otherwise.
+    exclusive = not is_other_job_active()
+    if SETTINGS['update-sde'] and not exclusive:
+        print('Skip: --update-sde while other jobs are running')
+    if SETTINGS['clear-cache'] and not exclusive:
+        print('Skip: --clear-cache while other jobs are running')
+
+    if SETTINGS['update-sde'] and not SETTINGS['offline'] and exclusive:
+        with startup_phase('update sde'):
+            sde2json.update_from_processed(
+                types_json_url='https://raw.githubusercontent.com/EVEKatsu/zkillboard2excel/master/types.json',
+                universes_json_url='https://raw.githubusercontent.com/EVEKatsu/zkillboard2excel/master/universes.json',
+                resources_path=SETTINGS['resources_path'],
+                manifest_url='https://raw.githubusercontent.com/EVEKatsu/zkillboard2excel/master/version.json',
+            )
 
-    if SETTINGS['clear-cache']:
-        CACHED.clear()
-    elif not CACHED:
-        CACHED.update(get_json_by_file(full_cached_json_path()))
+    with startup_phase('open cache'):
+        if not CACHED.is_open():
+            if SETTINGS['cache-backend'] == 'memory':
+                CACHED.open(cache.MemoryBackend())
+            else:
+                CACHED.open(cache.SqliteBackend(full_cached_db_path(), full_cached_json_path()))
 
-    if not CACHED:
-        for cached_key in CACHED_KEYS:
-            CACHED[cached_key] = {}
+        if not KILLMAIL_INDEX.is_open():
+            KILLMAIL_INDEX.open(':memory:' if SETTINGS['cache-backend'] == 'memory' else full_cached_index_db_path())
+            if KILLMAIL_INDEX.created:
+                # Killmails cached before the index existed.
+                KILLMAIL_INDEX.add(records.Killmail.from_value(value) for killmail_id_str, value in CACHED['killmails'].items())
+                KILLMAIL_INDEX.commit()
 
-    if not TYPES:
-        TYPES.update(get_json_by_file(full_types_json_path()))
+        if SETTINGS['clear-cache'] and exclusive:
+            clear_cache()
 
-    if not UNIVERSES:
-        UNIVERSES.update(get_json_by_file(full_universes_json_path()))
+        CACHED.policy('killmails').max_entries = SETTINGS['cache-max']
 
-    if not LOCALE_MENUITEMS:
-        LOCALE_MENUITEMS.update(get_json_by_file(full_locale_menuitems_json_path()))
+    # The SDE index and the menu items are loaded on first use.
+    if (SETTINGS['update-sde'] and exclusive) or not SDE.is_open():
+        SDE.open(SETTINGS['resources_path'])
 
 def get_json_by_file(path):
     if os.path.isfile(path):
@@ -160,16 +399,29 @@ def get_json_by_file(path):
     return {}
 
 def get_json_by_url(url):
-    while(True):
-        try:
-            print('Download: ' + url)
-            with urllib.request.urlopen(url) as html:
-                data = json.loads(html.read().decode())
-            time.sleep(0.1)
-            return data
-        except urllib.error.HTTPError:
-            print('urllib.error.HTTPError: ' + url)
-            time.sleep(10)
+    with metrics.stage('get_json_by_url'):
+        while(True):
+            check_cancelled()
+            try:
+                print('Download: ' + url)
+                return httpclient.get_json(url)
+            except urllib.error.HTTPError as e:
+                print('urllib.error.HTTPError: ' + url)
+                # Asking again does not make it exist. Other errors wait for the rate limiter of the host.
+                if e.code == 404:
+                    raise
+
+def post_json_by_url(url, value):
+    with metrics.stage('post_json_by_url'):
+        while(True):
+            check_cancelled()
+            try:
+                print('Download: ' + url)
+                return httpclient.post_json(url, value)
+            except urllib.error.HTTPError as e:
+                print('urllib.error.HTTPError: ' + url)
+                if e.code == 404:
+                    return None
 
 def get_link(target_key, target_id, name):
     url = 'https://zkillboard.com/%s/%d/' % (target_key, target_id)
@@ -183,29 +435,29 @@ def get_killmail_id_for_excel(killmail, zkb):
     return get_link('kill', killmail_id, killmail_id)
 
 def get_killmail_time(killmail, zkb):
-    date = datetime.datetime.strptime(killmail['killmail_time'], '%Y-%m-%dT%H:%M:%SZ')
-    return date.strftime('%Y-%m-%d %H:%M')
+    return time.strftime('%Y-%m-%d %H:%M', time.gmtime(killmail['killmail_time']))
+
+def get_killmail_time_for_excel(killmail, zkb):
+    # A datetime cell, so Excel can sort and filter by it. openpyxl writes naive datetimes as they are.
+    return UNIX_EPOCH + datetime.timedelta(seconds=killmail['killmail_time'])
 
 def get_ship(killmail, zkb):
-    type_id = killmail['ship_id']
-    return TYPES['types'][str(type_id)][SETTINGS['lang']]
+    return SDE.types.name(killmail['ship_id'], SETTINGS['lang'])
 
 def get_ship_for_excel(killmail, zkb):
     return get_link('ship', killmail['ship_id'], get_ship(killmail, zkb))
 
 def get_security(killmail, zkb):
-    system_id = killmail['system_id']
-    return round(UNIVERSES['systems'][str(system_id)]['security'], 1)
+    return round(SDE.systems.value('security', killmail['system_id']), 1)
 
 def get_region(killmail, zkb):
-    return UNIVERSES['regions'][str(killmail['region_id'])][SETTINGS['lang']]
+    return SDE.regions.name(killmail['region_id'], SETTINGS['lang'])
 
 def get_region_for_excel(killmail, zkb):
     return get_link('region', killmail['region_id'], get_region(killmail, zkb))
 
 def get_system(killmail, zkb):
-    system_id = killmail['system_id']
-    return UNIVERSES['systems'][str(system_id)][SETTINGS['lang']]
+    return SDE.systems.name(killmail['system_id'], SETTINGS['lang'])
 
 def get_system_for_excel(killmail, zkb):
     return get_link('system', killmail['system_id'], get_system(killmail, zkb))
@@ -226,16 +478,32 @@ def get_involved(killmail, zkb):
     return killmail['involved']
 
 def get_player(player_key, player_id):
+    # Lookups are counted in the cache metrics by resolve_names(), once per ID and page, not here per row.
     player_id_str = str(player_id)
     esi_url = 'https://esi.evetech.net/latest/%s/%s/' % (player_key, player_id_str)
 
-    if player_id_str in CACHED[player_key]:
+    if SETTINGS['offline']:
+        # An old name beats the bare ID when nothing can be downloaded.
+        return CACHED[player_key].get_stale(player_id_str, player_id_str)
+
+    name = CACHED[player_key].get(player_id_str)
+    if name is not None:
         print('Cached: ' + esi_url)
-        return CACHED[player_key][player_id_str]
+        return name
+
+    if player_id in UNRESOLVABLE_NAMES:
+        return player_id_str
+
+    try:
+        name = get_json_by_url(esi_url)['name']
+    except urllib.error.HTTPError as e:
+        if e.code != 404:
+            raise
+        UNRESOLVABLE_NAMES.add(player_id)
+        return player_id_str
 
-    name = get_json_by_url(esi_url)['name']
     CACHED[player_key][player_id_str] = name
-    return name 
+    return name
 
 def get_character(killmail, zkb):
     name = ''
@@ -273,40 +541,173 @@ def get_alliance_for_excel(killmail, zkb):
         name = get_link('alliance', killmail['alliance_id'], name)
     return name
 
-def parse_killmail(killmail):
+COLUMNS = OrderedDict()
+
+def register_column(name, extractor, **renderers):
+    '''Registers a column. renderers maps a format such as 'excel' to a function used instead of extractor.'''
+    COLUMNS[name] = (extractor, renderers)
+
+register_column('killmail_id', get_killmail_id, excel=get_killmail_id_for_excel)
+register_column('killmail_time', get_killmail_time, excel=get_killmail_time_for_excel)
+register_column('ship', get_ship, excel=get_ship_for_excel)
+register_column('security', get_security)
+register_column('region', get_region, excel=get_region_for_excel)
+register_column('system', get_system, excel=get_system_for_excel)
+register_column('damage', get_damage)
+register_column('value', get_value, excel=get_value_for_excel)
+register_column('points', get_points)
+register_column('involved', get_involved)
+register_column('character', get_character, excel=get_character_for_excel)
+register_column('corporation', get_corporation, excel=get_corporation_for_excel)
+register_column('alliance', get_alliance, excel=get_alliance_for_excel)
+
+def get_column_names():
+    names = [name for name in SETTINGS['columns'] if name in COLUMNS]
+    return names or list(MENUITEMS)
+
+def compile_columns():
+    columns = []
+    for name in get_column_names():
+        extractor, renderers = COLUMNS[name]
+        columns.append(renderers.get(SETTINGS['format'], extractor))
+    return columns
+
+def parse_killmail(killmail, zkb=None):
+    zkb = zkb or {}
     ship_id = killmail['victim']['ship_type_id']
     system_id = killmail['solar_system_id']
-    constellation_id = UNIVERSES['systems'][str(system_id)]['constellation_id']
-    km = {
-        'killmail_id': killmail['killmail_id'],
-        'killmail_time': killmail['killmail_time'],
-        'damage_taken': killmail['victim']['damage_taken'],
-        'involved': len(killmail['attackers']),
-        'ship_id': ship_id,
-        'group_id': TYPES['types'][str(ship_id)]['group_id'],
-        'system_id': system_id,
-        'constellation_id': constellation_id,
-        'region_id':UNIVERSES['constellations'][str(constellation_id)]['region_id'],
-    }
-
-    for player_type in ['character', 'corporation', 'alliance']:
-        player_key = player_type + '_id'
-        if player_key in killmail['victim']:
-            km[player_key] = killmail['victim'][player_key]
-        else:
-            km[player_key] = None
+    victim = killmail['victim']
+
+    return records.Killmail(
+        killmail['killmail_id'],
+        records.parse_time(killmail['killmail_time']),
+        victim['damage_taken'],
+        len(killmail['attackers']),
+        ship_id,
+        SDE.types.value('group_id', ship_id),
+        system_id,
+        SDE.systems.value('constellation_id', system_id),
+        SDE.systems.value('region_id', system_id),
+        victim.get('character_id'),
+        victim.get('corporation_id'),
+        victim.get('alliance_id'),
+        zkb.get('totalValue'),
+        zkb.get('points'),
+    )
+
+def get_fetch_executor():
+    '''The download pool shared by every export, with the most --workers any of them asked for.
+
+    Called with FETCH_LOCK held, which also guards every submit, so no export submits to a pool being replaced.
+    '''
+    global FETCH_EXECUTOR, FETCH_WORKERS
+    workers = max(SETTINGS['workers'], 1)
+
+    if FETCH_WORKERS is None or workers > FETCH_WORKERS:
+        if FETCH_EXECUTOR is not None:
+            # Downloads already submitted still finish on the old pool.
+            FETCH_EXECUTOR.shutdown(wait=False)
+        FETCH_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        FETCH_WORKERS = workers
+    return FETCH_EXECUTOR
+
+def fetch_killmail(killmail_id_str, esi_url, zkb):
+    try:
+        killmail = get_json_by_url(esi_url)
+
+        # Timed with observe(), a stage is cheap next to the download.
+        started = time.perf_counter()
+        value = parse_killmail(killmail, zkb).to_value()
+        metrics.observe('parse_killmail', time.perf_counter() - started)
+
+        CACHED['killmails'][killmail_id_str] = value
+    finally:
+        with FETCH_LOCK:
+            FETCH_FUTURES.pop(killmail_id_str, None)
+
+def fetch_killmails(zkbs):
+    futures = []
+
+    for zkb in zkbs:
+        killmail_id_str = str(zkb['killmail_id'])
+
+        esi_url = 'https://esi.evetech.net/latest/killmails/%d/%s/' % (zkb['killmail_id'], zkb['zkb']['hash'])
+        cached = killmail_id_str in CACHED['killmails']
+        metrics.record_cache('killmails', cached)
+        if cached:
+            print('Cached: ' + esi_url)
+            continue
+
+        with FETCH_LOCK:
+            # Another export may be downloading the same killmail already.
+            future = FETCH_FUTURES.get(killmail_id_str)
+            if future is None:
+                future = get_fetch_executor().submit(fetch_killmail, killmail_id_str, esi_url, zkb['zkb'])
+                FETCH_FUTURES[killmail_id_str] = future
+
+        futures.append(future)
+
+    # Downloads go on in the pool, but a cancelled export stops waiting for them.
+    pending = futures
+    while pending:
+        check_cancelled()
+        done, pending = concurrent.futures.wait(pending, timeout=CANCEL_POLL_SECONDS)
+        for future in done:
+            future.result()
+
+def resolve_names(killmails):
+    seen = set()
+    player_ids = OrderedDict()
+    for killmail in killmails:
+        for player_type, player_key in NAMES_CATEGORIES.items():
+            player_id = killmail[player_type + '_id']
+            if not player_id or player_id in seen:
+                continue
 
-    return km
+            seen.add(player_id)
+
+            cached = str(player_id) in CACHED[player_key]
+            metrics.record_cache(player_key, cached)
+            if not cached and player_id not in UNRESOLVABLE_NAMES:
+                player_ids[player_id] = player_key
+
+    player_ids = list(player_ids.items())
+    batches = [player_ids[i:i + NAMES_LIMIT] for i in range(0, len(player_ids), NAMES_LIMIT)]
+    while batches:
+        batch = batches.pop()
+        names = post_json_by_url(NAMES_URL, [player_id for player_id, player_key in batch])
+
+        if names is None:
+            # ESI rejects the whole batch if any ID is invalid, so halve it until the invalid IDs are alone.
+            if len(batch) == 1:
+                UNRESOLVABLE_NAMES.add(batch[0][0])
+            else:
+                half = len(batch) // 2
+                batches.extend([batch[half:], batch[:half]])
+            continue
+
+        for name in names:
+            if name['category'] in NAMES_CATEGORIES:
+                CACHED[NAMES_CATEGORIES[name['category']]][str(name['id'])] = name['name']
+
+def get_header(names=None):
+    '''The localized names of names, the exported columns by default. A name without a locale is used as it is.'''
+    if not LOCALE_MENUITEMS:
+        with startup_phase('load menu items'):
+            LOCALE_MENUITEMS.update(get_json_by_file(full_locale_menuitems_json_path()))
 
-def get_killmails():
-    killmails = OrderedDict()
     header = []
+    for name in names or get_column_names():
+        if name in LOCALE_MENUITEMS:
+            header.append(LOCALE_MENUITEMS[name][SETTINGS['lang']])
+        else:
+            header.append(name)
+    return header
+
+def get_zkb_api_url():
     focus_key = None
     focus_id = None
 
-    for name in MENUITEMS:
-        header.append(LOCALE_MENUITEMS[name][SETTINGS['lang']])
-
     parse_result = urllib.parse.urlparse(SETTINGS['zkb_url'])
     zkb_url = parse_result.scheme + '://' + parse_result.netloc + '/api/'
 
@@ -327,120 +728,824 @@ def get_killmails():
         if not focus_key and value in FOCUS_KEYS:
             focus_key = value + '_id'
 
-    for limit in range(SETTINGS['limit']):
-        url = zkb_url + 'page/%d/' % (limit + SETTINGS['page'])
+    return (zkb_url, focus_key, focus_id)
+
+def get_killmails(stop_killmail_id=None, summary=None):
+    '''Yields (killmail, values, focused) for every killmail, one zKillboard page at a time.
 
-        for zkb in get_json_by_url(url):
-            killmail_id_str = str(zkb['killmail_id'])
+    Reads SETTINGS['limit'] pages. With stop_killmail_id, pages are read past the limit until the first
+    killmail at or below it, so that an incremental export never leaves a gap, and it stops there.
+    Every killmail is also added to summary, a records.KillmailStore, when it is given.
+    '''
+    zkb_url, focus_key, focus_id = get_zkb_api_url()
+    # The npz format writes the killmail fields, not the columns.
+    columns = compile_columns() if SETTINGS['format'] != 'npz' else []
 
-            esi_url = 'https://esi.evetech.net/latest/killmails/%d/%s/' % (zkb['killmail_id'], zkb['zkb']['hash'])
-            if killmail_id_str in CACHED['killmails']:
-                print('Cached: ' + esi_url)
-                killmail = CACHED['killmails'][killmail_id_str]
+    limit = 0
+    while limit < SETTINGS['limit'] or stop_killmail_id is not None:
+        check_cancelled()
+        if limit == SETTINGS['limit']:
+            print('Incremental: reading past --limit=%d to reach killmail %d' % (SETTINGS['limit'], stop_killmail_id))
+
+        url = zkb_url + 'page/%d/' % (limit + SETTINGS['page'])
+        limit += 1
+
+        zkbs = get_json_by_url(url)
+        reached = False
+        if stop_killmail_id is not None:
+            new_zkbs = [zkb for zkb in zkbs if zkb['killmail_id'] > stop_killmail_id]
+            reached = len(new_zkbs) < len(zkbs) or not zkbs
+            zkbs = new_zkbs
+
+        fetch_killmails(zkbs)
+
+        killmails = [records.Killmail.from_value(CACHED['killmails'][str(zkb['killmail_id'])]) for zkb in zkbs]
+        resolve_names(killmails)
+
+        # Timed per page, since timing every row would cost more than building some of them.
+        with metrics.stage('build_rows'):
+            rows = []
+            for killmail, zkb in zip(killmails, zkbs):
+                # The value of a killmail changes with market prices, so it is taken from the page.
+                killmail.value = zkb['zkb'].get('totalValue')
+                killmail.points = zkb['zkb'].get('points')
+
+                values = [column(killmail, zkb['zkb']) for column in columns]
+                if summary is not None:
+                    summary.add(killmail)
+                rows.append((killmail, values, bool(focus_key) and killmail[focus_key] == focus_id))
+        metrics.add('rows', len(rows))
+        KILLMAIL_INDEX.add(killmail for killmail, values, focused in rows)
+
+        yield from rows
+
+        save_cache()
+
+        if reached:
+            break
+
+def get_cached_killmails(summary=None):
+    '''Yields (killmail, values, focused) for every exported killmail that matches the offline filters, newest first.
+
+    The killmails come from KILLMAIL_INDEX and nothing is downloaded. Names missing from the cache are exported as their IDs.
+    '''
+    columns = compile_columns() if SETTINGS['format'] != 'npz' else []
+
+    killmails = KILLMAIL_INDEX.select(
+        since=query.parse_time(SETTINGS['since']) if SETTINGS['since'] else None,
+        until=query.parse_time(SETTINGS['until']) if SETTINGS['until'] else None,
+        **{field: SETTINGS[name] for name, field in OFFLINE_FILTERS.items()}
+    )
+
+    count = 0
+    while True:
+        check_cancelled()
+
+        batch = list(itertools.islice(killmails, OFFLINE_BATCH_ROWS))
+        if not batch:
+            break
+
+        with metrics.stage('build_rows'):
+            rows = []
+            for killmail in batch:
+                # Killmails cached by older versions have no value and points.
+                killmail.value = killmail.value or 0
+                killmail.points = killmail.points or 0
+                zkb = {'totalValue': killmail.value, 'points': int(killmail.points)}
+
+                values = [column(killmail, zkb) for column in columns]
+                if summary is not None:
+                    summary.add(killmail)
+                rows.append((killmail, values, False))
+        metrics.add('rows', len(rows))
+
+        count += len(rows)
+        yield from rows
+
+    print('Offline: %d of %d exported killmails' % (count, len(KILLMAIL_INDEX)))
+
+def remember_newest_killmail(rows, newest):
+    for killmail, values, focused in rows:
+        if newest['killmail_id'] is None or killmail['killmail_id'] > newest['killmail_id']:
+            newest['killmail_id'] = killmail['killmail_id']
+        yield (killmail, values, focused)
+
+def get_summary_label(name, key):
+    lang = SETTINGS['lang']
+    if name == 'region' and key in SDE.regions:
+        return SDE.regions.name(key, lang)
+    if name == 'system' and key in SDE.systems:
+        return SDE.systems.name(key, lang)
+    if name == 'group' and key in SDE.groups:
+        return SDE.groups.name(key, lang)
+    if name in ('corporation', 'alliance'):
+        return get_player(name + 's', key)
+    if name == 'day':
+        return aggregate.format_day(key)
+    return str(key)
+
+def get_summaries(summary):
+    '''Yields (name, header, rows) of every summary, with names in place of IDs.'''
+    for name in aggregate.GROUPS:
+        header = get_header([name] + list(SUMMARY_COLUMNS))
+
+        rows = []
+        for key, kills, value, points in aggregate.aggregate(summary, name, SETTINGS['summary-top']):
+            rows.append([get_summary_label(name, key), kills, int(value), int(points)])
+
+        yield name, header, rows
+
+def write_csv_summaries(summary):
+    for name, header, rows in get_summaries(summary):
+        with open(SETTINGS['fullpath'] + '_' + name + '.csv', 'w') as file:
+            writer = csv.writer(file, lineterminator='\n')
+            writer.writerow(header)
+            writer.writerows(rows)
+
+def write_excel_summaries(wb, summary):
+    '''Adds a sheet per summary. They hold plain values, so Excel has nothing to recalculate.'''
+    for name, header, rows in get_summaries(summary):
+        sheet = wb.create_sheet(name)
+        sheet.append(header)
+        for values in rows:
+            sheet.append(get_excel_row(sheet, values, 'normal'))
+
+def zkillboard2npz(rows, append=False):
+    '''Writes the killmail fields as numpy arrays. numpy is not needed to write them.'''
+    path = SETTINGS['fullpath'] + '.npz'
+    store = records.KillmailStore.load_npz(path) if append else records.KillmailStore()
+
+    timer = metrics.Timer('write_rows')
+    for killmail, values, focused in rows:
+        with timer:
+            store.add(killmail)
+    timer.record()
+
+    with metrics.stage('save_file'):
+        store.save_npz(path)
+
+def zkillboard2csv(rows, append=False):
+    with open(SETTINGS['fullpath'] + '.csv', 'a' if append else 'w') as file:
+        writer = csv.writer(file, lineterminator='\n')
+        if not append:
+            writer.writerow(get_header())
+
+        timer = metrics.Timer('write_rows')
+        for killmail, values, focused in rows:
+            with timer:
+                writer.writerow(values)
+        timer.record()
+
+def create_excel_styles(wb):
+    '''Adds the named styles of EXCEL_STYLES that wb does not have yet, e.g. files exported by older versions.'''
+    side = openpyxl.styles.Side(style='thin', color='000000')
+    font = openpyxl.styles.Font(color='FFFFFF')
+    border = openpyxl.styles.Border(top=side, bottom=side, left=side)
+    tail_border = openpyxl.styles.Border(top=side, bottom=side)
+
+    styles = []
+    for name, background in EXCEL_STYLES.items():
+        fill = openpyxl.styles.PatternFill(patternType='solid', fgColor=background, bgColor=background)
+        styles.append(openpyxl.styles.NamedStyle(name=name, font=font, fill=fill, border=border))
+        styles.append(openpyxl.styles.NamedStyle(name=name + '_time', font=font, fill=fill, border=border, number_format=EXCEL_TIME_FORMAT))
+        styles.append(openpyxl.styles.NamedStyle(name=name + '_tail', fill=fill, border=tail_border))
+
+    for style in styles:
+        if style.name not in wb.named_styles:
+            wb.add_named_style(style)
+
+def get_excel_cell_style(value, style):
+    return style + '_time' if isinstance(value, datetime.datetime) else style
+
+def get_excel_row(sheet, values, style):
+    cells = []
+    for value in values:
+        cell = openpyxl.cell.WriteOnlyCell(sheet, value=value)
+        cell.style = get_excel_cell_style(value, style)
+        cells.append(cell)
+
+    for _ in range(EXCEL_TAIL_COLUMNS):
+        cell = openpyxl.cell.WriteOnlyCell(sheet)
+        cell.style = style + '_tail'
+        cells.append(cell)
+
+    return cells
+
+def get_excel_epoch(value):
+    '''Seconds since 1970-01-01 UTC of a datetime cell, None for any other value.'''
+    if isinstance(value, datetime.datetime):
+        # Excel keeps times as fractions of a day, so they come back a microsecond off.
+        return round((value - UNIX_EPOCH).total_seconds())
+    return None
+
+def is_excel_shard(title):
+    '''Whether the sheet title of an exported workbook belongs to a sheet of killmails.'''
+    return title != EXCEL_INDEX_TITLE and title not in aggregate.GROUPS
+
+def has_excel_shards(path):
+    '''Whether the exported workbook path has sheets of killmails, unlike the index of an export sharded into files.'''
+    import_openpyxl()
+    wb = openpyxl.load_workbook(path, read_only=True)
+    try:
+        return any(is_excel_shard(title) for title in wb.sheetnames)
+    finally:
+        wb.close()
+
+def read_excel_shards(wb):
+    '''Returns the sheets of killmails of an exported workbook and their ShardInfo, in order.
+
+    The counts and times come from the index sheet, or from the sheet itself when there is no index.
+    '''
+    sheets = [sheet for sheet in wb.worksheets if is_excel_shard(sheet.title)]
+    shards = [ShardInfo(sheet.title) for sheet in sheets]
+
+    if EXCEL_INDEX_TITLE in wb.sheetnames:
+        for shard, row in zip(shards, wb[EXCEL_INDEX_TITLE].iter_rows(min_row=2)):
+            shard.rows = row[1].value or 0
+            shard.newest = get_excel_epoch(row[2].value)
+            shard.oldest = get_excel_epoch(row[3].value)
+        return sheets, shards
+
+    time_header = get_header(['killmail_time'])[0]
+    for sheet, shard in zip(sheets, shards):
+        header = [cell.value for cell in sheet[1]]
+        column = header.index(time_header) if time_header in header else None
+
+        for row in sheet.iter_rows(min_row=2):
+            killmail_time = get_excel_epoch(row[column].value) if column is not None else None
+            if killmail_time is None:
+                shard.rows += 1
+            else:
+                shard.add_time(killmail_time)
+    return sheets, shards
+
+def get_new_shard_title(month, titles):
+    '''The title of a sheet added by an incremental export: the next number, or the month, numbered if taken.'''
+    if not month:
+        numbers = [int(title) for title in titles if title.isdigit()]
+        return str(max(numbers, default=0) + 1)
+
+    title = month
+    number = 2
+    while title in titles:
+        title = '%s %d' % (month, number)
+        number += 1
+    return title
+
+def append_excel(rows):
+    '''Appends rows to an existing export. Only used for incremental exports.
+
+    The new killmails go, newest first like in every other format, to the end of the first shard with room,
+    of their month with --shard-by=month. Without one a new shard is added in front of the old ones,
+    and the index sheet is written again.
+    '''
+    path = SETTINGS['fullpath'] + '.xlsx'
+    wb = openpyxl.load_workbook(path)
+    create_excel_styles(wb)
+    sheets, shards = read_excel_shards(wb)
+
+    budget = max(SETTINGS['shard-rows'], 1)
+    titles = set(wb.sheetnames)
+    added = 0
+
+    timer = metrics.Timer('write_rows')
+    for killmail, values, focused in rows:
+        month = ''
+        if SETTINGS['shard-by'] == 'month':
+            month = time.strftime('%Y-%m', time.gmtime(killmail['killmail_time']))
+
+        i = next((i for i, shard in enumerate(shards) if shard.name[:len(month)] == month and shard.rows < budget), None)
+
+        with timer:
+            if i is None:
+                if len(shards) == 1 and shards[0].name == 'Sheet':
+                    # The only sheet of an export by rows becomes the first of several.
+                    titles.discard('Sheet')
+                    sheets[0].title = shards[0].name = '1'
+                    titles.add('1')
+
+                title = get_new_shard_title(month, titles)
+                titles.add(title)
+                # After the shards added before, which hold newer killmails.
+                i = added
+                sheets.insert(i, wb.create_sheet(title, wb.worksheets.index(sheets[i])))
+                sheets[i].append(get_header())
+                shards.insert(i, ShardInfo(title))
+                added += 1
+
+            sheets[i].append(get_excel_row(sheets[i], values, 'focus' if focused else 'normal'))
+        shards[i].add(killmail)
+    timer.record()
+
+    if len(shards) > 1:
+        if EXCEL_INDEX_TITLE in wb.sheetnames:
+            wb.remove(wb[EXCEL_INDEX_TITLE])
+        write_excel_index(wb.create_sheet(EXCEL_INDEX_TITLE, 0), shards)
+
+    with metrics.stage('save_file'):
+        wb.save(path)
+
+def write_excel_sheet(sheet, rows, lock=None):
+    '''Appends the header and rows to a write-only sheet. lock guards a workbook shared by several threads.'''
+    lock = lock or contextlib.nullcontext()
+
+    with lock:
+        sheet.append(get_header())
+
+    timer = metrics.Timer('write_rows')
+    for killmail, values, focused in rows:
+        style = 'focus' if focused else 'normal'
+        with timer, lock:
+            sheet.append(get_excel_row(sheet, values, style))
+    timer.record()
+
+def get_shards(rows):
+    '''Yields (shard, killmail, values, focused) for rows, where shard names the shard of the row.
+
+    A shard takes up to SETTINGS['shard-rows'] rows and, with --shard-by=month, only rows of its month.
+    zKillboard lists killmails by ID, not by time, so rows of different months may come mixed and
+    their shards are filled side by side. Shards by rows are numbered from 1. Shards by month are
+    named after it, e.g. '2019-03', and numbered from 2 when one month takes several, e.g. '2019-03 2'.
+    '''
+    budget = max(SETTINGS['shard-rows'], 1)
+    numbers = {}
+    # The shard each month is filling and its number of rows.
+    filling = {}
+
+    for killmail, values, focused in rows:
+        if SETTINGS['shard-by'] == 'month':
+            month = time.strftime('%Y-%m', time.gmtime(killmail['killmail_time']))
+        else:
+            month = ''
+
+        shard, count = filling.get(month, (None, 0))
+        if shard is None or count >= budget:
+            number = numbers[month] = numbers.get(month, 0) + 1
+            if not month:
+                shard = str(number)
+            elif number == 1:
+                shard = month
             else:
-                killmail = parse_killmail(get_json_by_url(esi_url))
-                CACHED['killmails'][killmail_id_str] = killmail
+                shard = '%s %d' % (month, number)
+            count = 0
+
+        filling[month] = (shard, count + 1)
+        yield (shard, killmail, values, focused)
+
+class ShardInfo:
+    '''The name, row count and killmail times of a shard, listed on the index sheet.'''
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        self.newest = None
+        self.oldest = None
+
+    def add(self, killmail):
+        self.add_time(killmail['killmail_time'])
+
+    def add_time(self, killmail_time):
+        self.rows += 1
+        if self.newest is None or killmail_time > self.newest:
+            self.newest = killmail_time
+        if self.oldest is None or killmail_time < self.oldest:
+            self.oldest = killmail_time
+
+def write_excel_index(sheet, shards, paths=None):
+    '''Lists shards on sheet with a link to each sheet, or to each file of paths.'''
+    sheet.append(get_header(EXCEL_INDEX_COLUMNS))
+
+    for i, shard in enumerate(shards):
+        if paths is None:
+            link = '=HYPERLINK("#\'%s\'!A1", "%s")' % (shard.name, shard.name)
+        else:
+            # Relative to the index file, so the export can be moved as a whole.
+            link = '=HYPERLINK("%s", "%s")' % (os.path.basename(paths[i]), shard.name)
+
+        times = [
+            UNIX_EPOCH + datetime.timedelta(seconds=shard_time) if shard_time is not None else None
+            for shard_time in (shard.newest, shard.oldest)
+        ]
+        sheet.append(get_excel_row(sheet, [link, shard.rows] + times, 'normal'))
+
+def write_excel_sheets(wb, rows):
+    '''Writes rows to a sheet per shard of wb. Returns the ShardInfo of every sheet.'''
+    shards = OrderedDict()
+    sheets = {}
+    timer = metrics.Timer('write_rows')
+
+    for shard, killmail, values, focused in get_shards(rows):
+        if shard not in shards:
+            sheets[shard] = wb.create_sheet(shard)
+            sheets[shard].append(get_header())
+            shards[shard] = ShardInfo(shard)
+
+        style = 'focus' if focused else 'normal'
+        with timer:
+            sheets[shard].append(get_excel_row(sheets[shard], values, style))
+        shards[shard].add(killmail)
+    timer.record()
+
+    shards = list(shards.values())
+
+    if not shards:
+        wb.create_sheet().append(get_header())
+    elif len(shards) == 1 and SETTINGS['shard-by'] == 'rows':
+        # Exports that fit one sheet look as they did before sharding.
+        sheets[shards[0].name].title = 'Sheet'
+    return shards
+
+def write_excel_file(path, header, rows):
+    '''Writes header and rows, a list of (values, focused), to the Excel file path. Runs in a worker process.'''
+    import_openpyxl()
+
+    wb = openpyxl.Workbook(write_only=True)
+    create_excel_styles(wb)
+    sheet = wb.create_sheet()
+    sheet.append(header)
+    for values, focused in rows:
+        sheet.append(get_excel_row(sheet, values, 'focus' if focused else 'normal'))
+
+    wb.save(path)
+    return os.path.getsize(path)
+
+def write_excel_files(rows):
+    '''Writes a file per shard of rows in worker processes. Returns the ShardInfo and path of every file.
+
+    A shard is collected in memory and handed to a worker once it is full, while the next ones are downloaded.
+    At most one shard per worker is waiting to be written, and one shard per month is being filled.
+    '''
+    header = get_header()
+    budget = max(SETTINGS['shard-rows'], 1)
+    shards = OrderedDict()
+    paths = {}
+    buffers = {}
+    pending = set()
+    max_pending = EXCEL_WORKERS or os.cpu_count() or 1
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=EXCEL_WORKERS) as executor:
+        def submit(shard):
+            while len(pending) >= max_pending:
+                check_cancelled()
+                done, not_done = concurrent.futures.wait(pending, timeout=CANCEL_POLL_SECONDS, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    metrics.add('bytes_written', future.result())
+                pending.difference_update(done)
+
+            pending.add(executor.submit(write_excel_file, paths[shard], header, buffers.pop(shard)))
+
+        for shard, killmail, values, focused in get_shards(rows):
+            if shard not in shards:
+                shards[shard] = ShardInfo(shard)
+                paths[shard] = '%s_%s.xlsx' % (SETTINGS['fullpath'], shard.replace(' ', '_'))
+                buffers[shard] = []
+
+            buffers[shard].append((values, focused))
+            shards[shard].add(killmail)
+            if len(buffers[shard]) >= budget:
+                submit(shard)
+
+        for shard in list(buffers):
+            submit(shard)
+
+        with metrics.stage('save_file'):
+            for future in concurrent.futures.as_completed(pending):
+                metrics.add('bytes_written', future.result())
+
+    return list(shards.values()), [paths[shard] for shard in shards]
+
+def zkillboard2excel(rows, append=False, summary=None):
+    import_openpyxl()
+
+    if append:
+        append_excel(rows)
+        return
+
+    wb = openpyxl.Workbook(write_only=True)
+    create_excel_styles(wb)
+    if SETTINGS['shard-output'] == 'files':
+        # The export file becomes the index of the shard files.
+        shards, paths = write_excel_files(rows)
+        write_excel_index(wb.create_sheet(EXCEL_INDEX_TITLE), shards, paths)
+    else:
+        shards = write_excel_sheets(wb, rows)
+        if len(shards) > 1:
+            write_excel_index(wb.create_sheet(EXCEL_INDEX_TITLE, 0), shards)
 
-            values = []
-            for name in MENUITEMS:
-                func_name = 'get_' + name
+    if summary is not None:
+        write_excel_summaries(wb, summary)
 
-                if SETTINGS['format'] == 'excel' and func_name + '_for_excel' in globals():
-                    func_name += '_for_excel'
+    with metrics.stage('save_file'):
+        wb.save(SETTINGS['fullpath'] + '.xlsx')
 
-                values.append(globals()[func_name](killmail, zkb['zkb']))
+def save_settings_json():
+    with open(full_setting_json_path(), 'w', encoding='utf-8') as file:
+        json.dump(dict(SETTINGS), file, indent=4)
 
-            killmails[zkb['killmail_id']] = values
+def get_incremental(zkb_url, export_path):
+    '''The newest killmail ID exported from zkb_url to the file export_path, or None.'''
+    incremental = get_json_by_file(full_incremental_json_path())
+    return incremental.get(export_path, {}).get(zkb_url)
 
-        save_cache_json()
+def save_incremental(zkb_url, export_path, killmail_id):
+    # Kept per file, as other files of the same URL may have been exported at other times.
+    with INCREMENTAL_LOCK:
+        incremental = get_json_by_file(full_incremental_json_path())
+        incremental.setdefault(export_path, {})[zkb_url] = killmail_id
 
-    return (killmails, header, focus_key, focus_id)
+        with open(full_incremental_json_path(), 'w', encoding='utf-8') as file:
+            json.dump(incremental, file, indent=4)
 
-def zkillboard2csv():
-    killmails, header, focus_key, focus_id = get_killmails()
+def save_cache():
+    CACHED.commit()
+    KILLMAIL_INDEX.commit()
 
-    with open(SETTINGS['fullpath'] + '.csv', 'w') as file:
-        writer = csv.writer(file, lineterminator='\n')
-        writer.writerow(header)
-        writer.writerows(killmails.values())
-
-def zkillboard2excel():
-    killmails, header, focus_key, focus_id = get_killmails()
-
-    wb = openpyxl.Workbook()
-    sheet = wb.active
-
-    for i, header_name in enumerate(header):
-        sheet.cell(row=1, column=i+1).value = header_name
-
-    row = 2
-    for killmail_id, killmail in killmails.items():
-        background = '006400'
-        if focus_key and CACHED['killmails'][str(killmail_id)][focus_key] == focus_id:
-            background = '8B0000'
-
-        pattern_fill = openpyxl.styles.PatternFill(patternType='solid', fgColor=background, bgColor=background)
-        border = openpyxl.styles.Border(
-            top=openpyxl.styles.Side(style='thin', color='000000'),
-            bottom=openpyxl.styles.Side(style='thin', color='000000'),
-            left=openpyxl.styles.Side(style='thin', color='000000'),
-            #right=openpyxl.styles.Side(style='thin', color='000000'),
-        )
-
-        for i, value in enumerate(killmail):
-            cell = sheet.cell(row=row, column=i+1)
-            cell.value = value
-            cell.font = openpyxl.styles.fonts.Font(color='FFFFFF')
-            cell.fill = pattern_fill
-            cell.border = border
-
-        for j in range(3):
-            cell = sheet.cell(row=row, column=len(MENUITEMS)+j+1)
-            cell.fill = pattern_fill
-            cell.border = openpyxl.styles.Border(
-                top=openpyxl.styles.Side(style='thin', color='000000'),
-                bottom=openpyxl.styles.Side(style='thin', color='000000'),
-            )
+def clear_cache():
+    CACHED.clear()
+    KILLMAIL_INDEX.clear()
 
-        row += 1
+def prepare_fullpath(filepath):
+    fullpath = os.path.join(os.path.expanduser('~/Desktop/'), filepath)
+    dirname = os.path.dirname(fullpath)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname, exist_ok=True)
+    return fullpath
 
-    wb.save(SETTINGS['fullpath'] + '.xlsx')
+def export(sheet=None, lock=None):
+    '''Exports SETTINGS['zkb_url'] to a file, or into sheet of a shared write-only workbook.'''
+    SETTINGS['fullpath'] = prepare_fullpath(SETTINGS['filepath'])
 
-def save_settings_json():
-    with open(full_setting_json_path(), 'w', encoding='utf-8') as file:
-        json.dump(SETTINGS, file, indent=4)
+    export_path = SETTINGS['fullpath'] + FORMAT_EXTENSIONS[SETTINGS['format']]
+    zkb_url = get_zkb_api_url()[0]
+
+    # The index file of an export sharded into files has no killmails to append to, so it is exported again.
+    sharded_files = SETTINGS['format'] == 'excel' and SETTINGS['shard-output'] == 'files'
+
+    stop_killmail_id = None
+    if SETTINGS['incremental'] and not SETTINGS['offline'] and not sharded_files and sheet is None and os.path.isfile(export_path):
+        stop_killmail_id = get_incremental(zkb_url, export_path)
+
+        if stop_killmail_id is not None and SETTINGS['format'] == 'excel' and not has_excel_shards(export_path):
+            # The index left by --shard-output=files has nothing to append to, so it is exported again.
+            stop_killmail_id = None
+
+    append = stop_killmail_id is not None
+
+    # A summary of only the killmails appended by an incremental export would be misleading.
+    summary = None
+    if SETTINGS['summary'] and sheet is None and not append:
+        summary = records.KillmailStore()
+
+    newest = {'killmail_id': stop_killmail_id}
+    if SETTINGS['offline']:
+        rows = get_cached_killmails(summary)
+    else:
+        rows = remember_newest_killmail(get_killmails(stop_killmail_id, summary), newest)
+
+    if sheet is not None:
+        write_excel_sheet(sheet, rows, lock)
+    elif SETTINGS['format'] == 'excel':
+        zkillboard2excel(rows, append, summary)
+    else:
+        if SETTINGS['format'] == 'npz':
+            zkillboard2npz(rows, append)
+        else:
+            zkillboard2csv(rows, append)
+
+        if summary is not None:
+            write_csv_summaries(summary)
+
+    if sheet is None:
+        metrics.add('bytes_written', os.path.getsize(export_path))
+
+    if SETTINGS['incremental'] and not SETTINGS['offline'] and sheet is None and newest['killmail_id'] is not None:
+        save_incremental(zkb_url, export_path, newest['killmail_id'])
+
+def finish():
+    if SETTINGS['clear-cache'] and not is_other_job_active():
+        clear_cache()
 
-def save_cache_json():
-    with open(full_cached_json_path(), 'w', encoding='utf-8') as file:
-        json.dump(CACHED, file)
+    httpclient.report()
 
-def clear_cache_json():
-    if os.path.isfile(full_cached_json_path()):
-        os.remove(full_cached_json_path())
+    if SETTINGS['metrics']:
+        metrics.dump(SETTINGS['metrics'])
+
+    if SETTINGS['startup-profile']:
+        print_startup_profile()
+    STARTUP_TIMINGS.clear()
 
 def run(resources_path='.'):
     SETTINGS['resources_path'] = resources_path
+    metrics.reset()
 
     initialize()
+    try:
+        export()
+    finally:
+        # Killmails downloaded before an error or a cancel are kept.
+        save_cache()
+    finish()
+
+def run_job(settings, cancel_event=None):
+    '''Runs one export with its own settings on the current thread.
+
+    Setting cancel_event stops it between requests and pages with Cancelled.
+    '''
+    SETTINGS.use(settings)
+    use_cancel_event(cancel_event)
+    with ACTIVE_JOBS_LOCK:
+        ACTIVE_JOBS.add(threading.get_ident())
+    try:
+        initialize(load_settings=False)
+        try:
+            export()
+        finally:
+            save_cache()
+        finish()
+    finally:
+        with ACTIVE_JOBS_LOCK:
+            ACTIVE_JOBS.discard(threading.get_ident())
+        use_cancel_event(None)
+        SETTINGS.use(None)
+
+def get_batch_sheet_title(zkb_url, titles):
+    path = urllib.parse.urlparse(zkb_url).path
+    title = ' '.join(value for value in path.split('/') if value) or 'Sheet'
+
+    # Excel limits sheet titles to 31 characters without []:*?/\\.
+    for char in '[]:*?/\\':
+        title = title.replace(char, '_')
+    title = title[:28]
+
+    unique_title = title
+    number = 2
+    while unique_title in titles:
+        unique_title = '%s %d' % (title, number)
+        number += 1
+
+    titles.add(unique_title)
+    return unique_title
+
+def get_batch_filepath(zkb_url):
+    path = urllib.parse.urlparse(zkb_url).path
+    return '_'.join([SETTINGS['filepath']] + [value for value in path.split('/') if value])
+
+def read_batch_file(path):
+    '''Reads a batch file. Each line is a zKillboard URL followed by options, blank lines and # comments are skipped.'''
+    jobs = []
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            arguments = line.split()
+            if not arguments or arguments[0].startswith('#'):
+                continue
 
-    SETTINGS['fullpath'] = os.path.join(os.path.expanduser('~/Desktop/'), SETTINGS['filepath'])
-    dirname = os.path.dirname(SETTINGS['fullpath'])
-    if not os.path.isdir(dirname):
-        os.makedirs(dirname)
+            settings = dict(SETTINGS)
+            settings['zkb_url'] = arguments[0]
 
-    if SETTINGS['format'] == 'excel':
-        zkillboard2excel()
-    else:
-        zkillboard2csv()
+            if not any(argument.startswith('--filepath=') for argument in arguments[1:]):
+                settings['filepath'] = get_batch_filepath(arguments[0])
+
+            SETTINGS.use(settings)
+            parse_arguments(arguments[1:])
+            SETTINGS.use()
+
+            jobs.append(settings)
+    return jobs
+
+def run_batch(path, resources_path='.'):
+    '''Exports every URL of a batch file with up to SETTINGS['batch-jobs'] exports at the same time.
+
+    All exports share the cache, the HTTP pool, the rate limiters and the killmail downloads.
+    '''
+    SETTINGS['resources_path'] = resources_path
+    metrics.reset()
+
+    # The options come from the command line and the batch file, not from settings.json.
+    initialize(load_settings=False)
+    jobs = read_batch_file(path)
+
+    wb = None
+    lock = threading.Lock()
+    if SETTINGS['batch-output']:
+        import_openpyxl()
+        wb = openpyxl.Workbook(write_only=True)
+        create_excel_styles(wb)
+
+    titles = set()
+    sheets = []
+    for settings in jobs:
+        settings['resources_path'] = resources_path
+        if wb is not None:
+            # The shared workbook is an Excel file, so every sheet uses the Excel renderers.
+            settings['format'] = 'excel'
+            sheets.append(wb.create_sheet(get_batch_sheet_title(settings['zkb_url'], titles)))
+        else:
+            sheets.append(None)
+
+    def run_job(settings, sheet):
+        SETTINGS.use(settings)
+        export(sheet, lock)
 
-    if SETTINGS['clear-cache']:
-        clear_cache_json()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(SETTINGS['batch-jobs'], 1)) as executor:
+        futures = [executor.submit(run_job, settings, sheet) for settings, sheet in zip(jobs, sheets)]
+        for future in futures:
+            future.result()
 
+    if wb is not None:
+        batch_output_path = prepare_fullpath(SETTINGS['batch-output']) + '.xlsx'
+        with metrics.stage('save_file'):
+            wb.save(batch_output_path)
+        metrics.add('bytes_written', os.path.getsize(batch_output_path))
+
+    finish()
+
+def parse_arguments(arguments):
+    for argument in arguments:
+        try:
+            key, value = argument.split('=', 1)
+
+            if key == '--lang':
+                if value in LANGUAGES:
+                    SETTINGS['lang'] = value
+                else:
+                    print("Does not support '%s' language" % value)
+            elif key == '--filepath':
+                SETTINGS['filepath'] = value
+            elif key == '--format':
+                if value.lower() in FORMAT_EXTENSIONS:
+                    SETTINGS['format'] = value.lower()
+                else:
+                    print("Does not support '%s' format" % value)
+            elif key == '--clear-cache':
+                SETTINGS['clear-cache'] = value.lower() == 'true'
+            elif key == '--cache-max':
+                SETTINGS['cache-max'] = int(value)
+            elif key == '--cache-backend':
+                if value.lower() in cache.BACKENDS:
+                    SETTINGS['cache-backend'] = value.lower()
+                else:
+                    print("Does not support '%s' cache backend" % value)
+            elif key == '--update-sde':
+                SETTINGS['update-sde'] = value.lower() == 'true'
+            elif key == '--page':
+                SETTINGS['page'] = int(value)
+            elif key == '--limit':
+                SETTINGS['limit'] = int(value)
+            elif key == '--columns':
+                SETTINGS['columns'] = []
+                for name in value.split(','):
+                    if name in COLUMNS:
+                        SETTINGS['columns'].append(name)
+                    else:
+                        print("Does not support '%s' column" % name)
+            elif key == '--startup-profile':
+                SETTINGS['startup-profile'] = value.lower() == 'true'
+            elif key == '--incremental':
+                SETTINGS['incremental'] = value.lower() == 'true'
+            elif key == '--workers':
+                SETTINGS['workers'] = int(value)
+            elif key == '--batch':
+                SETTINGS['batch'] = value
+            elif key == '--batch-jobs':
+                SETTINGS['batch-jobs'] = int(value)
+            elif key == '--batch-output':
+                SETTINGS['batch-output'] = value
+            elif key == '--metrics':
+                SETTINGS['metrics'] = value
+            elif key == '--summary':
+                SETTINGS['summary'] = value.lower() == 'true'
+            elif key == '--summary-top':
+                SETTINGS['summary-top'] = int(value)
+            elif key == '--shard-rows':
+                SETTINGS['shard-rows'] = int(value)
+            elif key == '--shard-by':
+                if value.lower() in SHARD_MODES:
+                    SETTINGS['shard-by'] = value.lower()
+                else:
+                    print("Does not support '%s' shard mode" % value)
+            elif key == '--shard-output':
+                if value.lower() in SHARD_OUTPUTS:
+                    SETTINGS['shard-output'] = value.lower()
+                else:
+                    print("Does not support '%s' shard output" % value)
+            elif key == '--offline':
+                SETTINGS['offline'] = value.lower() == 'true'
+            elif key in ('--since', '--until'):
+                query.parse_time(value)
+                SETTINGS[key[2:]] = value
+            elif key in ('--region', '--group', '--corporation', '--alliance'):
+                SETTINGS[key[2:]] = [int(value_id) for value_id in value.split(',') if value_id]
+            else:
+                print("Option Error: '%s' does not exist" % key)
+        except ValueError:
+            print('Value Error: %s' % argument)
 
 def command_line():
     if len(sys.argv) < 2:
         print('''
 usage: python zkillboard2excel.py zKillboard-URL [options]
+       python zkillboard2excel.py --batch=path [options]
+       python zkillboard2excel.py --offline=true [options]
 Options and arguments:''')
 
         for option in OPTIONS:
@@ -448,37 +1553,17 @@ Options and arguments:''')
         return
 
     SETTINGS.update(copy.deepcopy(DEFAULT_SETTINGS))
-    SETTINGS['zkb_url'] = sys.argv[1]
 
-    if len(sys.argv) >= 3:
-        for argument in sys.argv[2:]:
-            try:
-                key, value = argument.split('=')
+    if sys.argv[1].startswith('--'):
+        parse_arguments(sys.argv[1:])
+    else:
+        SETTINGS['zkb_url'] = sys.argv[1]
+        parse_arguments(sys.argv[2:])
 
-                if key == '--lang':
-                    if value in LANGUAGES:
-                        SETTINGS['lang'] = value
-                    else:
-                        print("Does not support '%s' language" % value)
-                elif key == '--filepath':
-                    SETTINGS['filepath'] = value
-                elif key == '--format':
-                    if value.lower() in ['excel', 'csv']:
-                        SETTINGS['format'] = value.lower()
-                    else:
-                        print("Does not support '%s' format" % value)
-                elif key == '--clear-cache':
-                    SETTINGS['clear-cache'] = value.lower() == 'true'
-                elif key == '--update-sde':
-                    SETTINGS['update-sde'] = value.lower() == 'true'
-                elif key == '--page':
-                    SETTINGS['page'] = int(value)
-                elif key == '--limit':
-                    SETTINGS['limit'] = int(value)
-                else:
-                    print("Option Error: '%s' does not exist" % key)
-            except ValueError:
-                print('Value Error: %s' % argument)
+    if SETTINGS['batch']:
+        # A batch must not replace the settings of the desktop application.
+        run_batch(SETTINGS['batch'])
+        return
 
     save_settings_json()
 